@@ -5,29 +5,84 @@ from tqdm import tqdm
 from scipy.ndimage import gaussian_filter1d
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+import argparse
+import json
 import os
+import time
+import tracemalloc
 from ..helper.interpolate import interpolate_missing
-from ..helper.util import get_keypoints, get_marker_names, group_intervals
+from ..helper.pipeline import run_pipeline
+from ..helper.util import NUM_MARKERS, GapIndex, group_intervals, load_trial, parse_trial_name
+from ..helper.gpr_cache import HyperparameterCache
 
-# Check whether linear interpolation or GPR performs better on complete c3d data (we skip any markers with gaps)
+# Check which imputation method performs best on complete c3d data (we skip any markers with gaps)
 # We delete 'num_tests_interval' of length 'test_len_interval' from a complete marker, by setting the x, y, and z value at corresponding frames to NaN
-# We then calculate the average error from the ground truth for the linear and GPR interpolation
+# We then calculate the average error from the ground truth for every method in METHODS, together with its run time and memory
 
 DATA_DIR = Path('F:', 'MPC') # Location of the MPC dataset on your machine
 CSV_PATH = Path('..', 'output', 'lerp_vs_gpr.csv') # Path to csv file containing the errors 
 DO_PLOT = False # If True: Show a plot of every marker interpolation, comparing ground truth to linear and GPR interpolation
+GPR_CACHE_PATH = None # e.g. Path('..', 'output', 'gpr_cache.json'): warm-start the GPR from hyperparameters learned in earlier runs
+
+RECORDS_PATH = Path('..', 'output', 'lerp_vs_gpr_records.jsonl') # one result per (file, marker), appended as soon as it is computed
+METHODS_CSV_PATH = Path('..', 'output', 'lerp_vs_gpr_methods.csv') # Path to csv file comparing error, time and memory of the methods
+TRACE_MEMORY = False # Measure the peak memory of every method with tracemalloc, in an extra run of the method (doubles the run time)
 
 num_tests_interval = [1, 8]
 test_len_interval = [10, 100]
 take = 1
 use = 5
 
-random.seed(555) # set random seed to ensure consistency across multiple executions
-
-def main():
-    # take 24 files (3 in each subject, 4 for each action, 6 for each variation) and compute avg_error_lin, avg_error_gpr for every one
-    df = pd.DataFrame(columns=['avg_error_lin', 'avg_error_gpr'])
-    df.index.name = 'c3d_path'
+# name: (registered imputer, use, keyword arguments), see helper.interpolate.IMPUTERS
+METHODS = {
+    'lin': ('linear', 1, {}),
+    'gpr': ('gpr', use, {}),
+    'kalman': ('kalman', 1, {}),
+    'poly': ('polynomial', 1, {'deg': 80}),
+}
+# name: stages of helper.pipeline, run like in fix_c3d_folder on the captured frames before smoothing (the other methods get the smoothed frames)
+PIPELINES = {
+    'smooth_gpr': [('smooth', {'sigma': 3, 'nan_aware': False}), ('impute', {'method': 'gpr', 'use': use})], # gaussian_filter1d widens the gaps
+    'fused_gpr': [('smooth', {'sigma': 3}), ('impute', {'method': 'gpr', 'use': use})],
+    'fused_kalman': [('smooth', {'sigma': 3}), ('impute', {'method': 'kalman'})],
+}
+DEFAULT_METHODS = ['lin', 'gpr']
+GAP_BUCKETS = {'1-24': 1, '25-49': 25, '50-99': 50, '100+': 100} # label: shortest gap length
+
+SEED = 555 # every (file, marker) draws from its own random stream derived from this seed, so results do not depend on the order of execution
+
+def main(workers=1, resume=True, methods=None):
+    # take 24 files (3 in each subject, 4 for each action, 6 for each variation) and compute the error of every method for every one
+    methods = methods or DEFAULT_METHODS
+    c3d_paths = select_files()
+    if not resume: RECORDS_PATH.unlink(missing_ok=True)
+    drop_partial_record()
+    done = load_records()
+    # markers are recomputed if they lack one of the methods (e.g. a method was added since the last run)
+    tasks = [(c3d_path, kp_idx) for c3d_path in c3d_paths for kp_idx in range(NUM_MARKERS) if not has_methods(done.get((c3d_path, kp_idx)), methods)]
+    print(f'{len(done)} results found in {RECORDS_PATH}, {len(tasks)} left to compute')
+
+    with open(RECORDS_PATH, 'a') as file:
+        if workers > 1:
+            # consecutive markers of a file go to the same worker, so every file is parsed once per worker
+            with ProcessPoolExecutor(workers, initializer=init_worker) as executor:
+                results = executor.map(test_marker, *zip(*tasks), [methods] * len(tasks), chunksize=NUM_MARKERS) if tasks else []
+                append_records(file, results, len(tasks))
+        else:
+            init_worker()
+            append_records(file, (test_marker(*task, methods) for task in tasks), len(tasks))
+
+    records = load_records()
+    df = summarize(records, c3d_paths, methods)
+    df.to_csv(CSV_PATH)
+    summarize_methods(records, c3d_paths, methods).to_csv(METHODS_CSV_PATH)
+    return df
+
+
+def select_files():
+    c3d_paths = []
     for i in range(8):
         subj = f'S{i+1}'
         c3d_folder = os.path.join(DATA_DIR, subj, 'c3ds')
@@ -35,100 +90,201 @@ def main():
         files.sort()
         for j in range(3):
             file_idx = (8*j) + i
-            c3d_path = os.path.join(c3d_folder, files[file_idx])
-            avg_error_lin, avg_error_gpr = test_file(c3d_path)
-            df.loc[c3d_path] = [avg_error_lin, avg_error_gpr]
-            df.to_csv(CSV_PATH) # save to .csv after every iteration
+            c3d_paths.append(os.path.join(c3d_folder, files[file_idx]))
+    return c3d_paths
+
+
+def init_worker():
+    # single threaded BLAS, so the numbers do not depend on the number of workers
+    threadpool_limits(1)
+
+
+def append_records(file, results, total):
+    for record in tqdm(results, total=total):
+        file.write(json.dumps(record) + '\n')
+        file.flush() # a crash loses at most the markers that are still being computed
+
+
+def drop_partial_record():
+    # an interrupted run may have left half a line at the end of the file
+    if not RECORDS_PATH.is_file(): return
+    with open(RECORDS_PATH, 'rb+') as file:
+        content = file.read()
+        if content and not content.endswith(b'\n'):
+            file.truncate(content.rfind(b'\n') + 1)
 
 
-def test_file(c3d_file_path):
-    absolute_error_lin = 0
-    absolute_error_gpr = 0
+def load_records():
+    records = {}
+    if RECORDS_PATH.is_file():
+        with open(RECORDS_PATH) as file:
+            for line in file:
+                if not line.strip(): continue
+                record = json.loads(line)
+                records[(record['c3d_path'], record['marker_idx'])] = record
+    return records
 
-    marker_names = get_marker_names(c3d_file_path)
 
-    num_complete_keypoints = 0
-    for kp_idx, marker_name in enumerate(tqdm(marker_names)):
-        if DO_PLOT: print(marker_name)
-        x, y, z = get_keypoints(c3d_file_path, kp_idx)
-        point_data_3d = np.array([x, y, z])
-        if np.isnan(point_data_3d).any(): continue # skip incomplete keypoints
+def has_methods(record, methods):
+    if record is None or 'methods' not in record: return False # not computed, or written by an older version
+    return not record['complete'] or all(name in record['methods'] for name in methods)
 
-        error_lin, error_gpr = test_keypoint(point_data_3d)
-        absolute_error_lin += error_lin
-        absolute_error_gpr += error_gpr
-        num_complete_keypoints += 1
 
-    if num_complete_keypoints == 0:
-        avg_error_lin = np.NaN
-        avg_error_gpr = np.NaN
-    else:
-        avg_error_lin = absolute_error_lin / num_complete_keypoints
-        avg_error_gpr = absolute_error_gpr / num_complete_keypoints
+def finished_records(records, c3d_paths):
+    # the records of the complete markers of every file that is done, in marker order
+    for c3d_path in c3d_paths:
+        file_records = [records[(c3d_path, kp_idx)] for kp_idx in range(NUM_MARKERS) if (c3d_path, kp_idx) in records]
+        if len(file_records) < NUM_MARKERS: continue # not finished yet
+        yield c3d_path, [r for r in file_records if r['complete']]
+
+
+def summarize(records, c3d_paths, methods):
+    # average error over the complete markers of every file, summed in marker order
+    df = pd.DataFrame(columns=[f'avg_error_{name}' for name in methods])
+    df.index.name = 'c3d_path'
+    for c3d_path, complete in finished_records(records, c3d_paths):
+        if len(complete) == 0:
+            df.loc[c3d_path] = [np.nan] * len(methods)
+        else:
+            df.loc[c3d_path] = [sum(r['methods'][name]['error'] for r in complete) / len(complete) for name in methods]
+    return df
+
+
+def summarize_methods(records, c3d_paths, methods):
+    # one row per method: MAE and RMSE (in mm, per coordinate) overall and per gap length, and the cost of the method
+    df = pd.DataFrame(index=pd.Index(methods, name='method'), dtype=float)
+    complete = [r for _, file_records in finished_records(records, c3d_paths) for r in file_records]
+    for name in methods:
+        metrics = [r['methods'][name] for r in complete]
+        if len(metrics) == 0: continue
+        total = np.zeros(3)
+        for label in GAP_BUCKETS:
+            count, sum_abs, sum_sq = np.sum([m['buckets'][label] for m in metrics], axis=0)
+            total += (count, sum_abs, sum_sq)
+            df.loc[name, f'mae_{label}'] = sum_abs / count if count else np.nan
+            df.loc[name, f'rmse_{label}'] = np.sqrt(sum_sq / count) if count else np.nan
+        df.loc[name, 'mae'] = total[1] / total[0]
+        df.loc[name, 'rmse'] = np.sqrt(total[2] / total[0])
+        df.loc[name, 'wall_s'] = sum(m['wall_s'] for m in metrics)
+        df.loc[name, 'cpu_s'] = sum(m['cpu_s'] for m in metrics)
+        df.loc[name, 'peak_mem_mb'] = np.max([m['peak_mem_mb'] for m in metrics])
+        df.loc[name, 'fits'] = sum(m['fits'] for m in metrics)
+        df.loc[name, 'fits_per_s'] = df.loc[name, 'fits'] / df.loc[name, 'wall_s']
+        df.loc[name, 'fits_per_cpu_s'] = df.loc[name, 'fits'] / df.loc[name, 'cpu_s']
+    return df
+
+
+def test_file(c3d_file_path, methods=None):
+    methods = methods or DEFAULT_METHODS
+    records = {(c3d_file_path, kp_idx): test_marker(c3d_file_path, kp_idx, methods) for kp_idx in tqdm(range(NUM_MARKERS))}
+    avg_errors = summarize(records, [c3d_file_path], methods).loc[c3d_file_path]
 
     print('==========')
     print(c3d_file_path)
-    print('AVG_ERROR_LIN', avg_error_lin)
-    print('AVG_ERROR_GPR', avg_error_gpr)
+    for name in methods:
+        print(f'AVG_ERROR_{name.upper()}', avg_errors[f'avg_error_{name}'])
     print('==========')
 
-    return avg_error_lin, avg_error_gpr
+    return avg_errors
+
+
+def test_marker(c3d_file_path, kp_idx, methods=None):
+    trial = load_trial(c3d_file_path) # parsed once per process, while it stays in the cache
+    marker_name = trial.marker_names[kp_idx]
+    record = {'c3d_path': c3d_file_path, 'marker_idx': kp_idx, 'marker': marker_name, 'complete': False, 'methods': {}}
+    if DO_PLOT: print(marker_name)
+
+    if kp_idx not in trial.gaps.markers_without_gaps(): return record # skip incomplete keypoints
+    point_data_3d = np.array(trial.keypoints(kp_idx))
+
+    rng = random.Random(f'{SEED}:{Path(c3d_file_path).name}:{marker_name}')
+    kernels = None
+    if GPR_CACHE_PATH:
+        try:
+            subject, action, _ = parse_trial_name(c3d_file_path)
+        except ValueError:
+            pass # cache entries are keyed by subject and action, other trials are not cached
+        else:
+            kernels = gpr_cache().view(subject, action, marker_name)
+    record['complete'] = True
+    record['methods'] = test_keypoint(point_data_3d, rng, kernels, methods)
+    if GPR_CACHE_PATH: gpr_cache().save()
+    return record
+
+
+_gpr_cache = None
+def gpr_cache():
+    # one cache per process
+    global _gpr_cache
+    if _gpr_cache is None:
+        _gpr_cache = HyperparameterCache(GPR_CACHE_PATH)
+    return _gpr_cache
 
 
-def test_keypoint(point_data_3d: np.array):
+def test_keypoint(point_data_3d: np.array, rng: random.Random, kernels=None, methods=None):
     assert not np.isnan(point_data_3d).any() # only work with completely captured keypoints    
     assert point_data_3d.shape[0] == 3 # sanity check
     assert point_data_3d.shape[1] > 500 # check that we have enough points
+    methods = methods or DEFAULT_METHODS
     
     smooth_fact = 3
+    raw_points = point_data_3d.copy() # for the PIPELINES, which smooth themselves
     point_data_3d = np.apply_along_axis(lambda dim: gaussian_filter1d(dim, smooth_fact), axis=1, arr=point_data_3d)
 
-    x_gt, y_gt, z_gt = point_data_3d.copy()
+    gt_points = point_data_3d.copy()
     x, y, z = point_data_3d
 
-    num_tests = random.randint(*num_tests_interval)
+    num_tests = rng.randint(*num_tests_interval)
     for _ in range(num_tests):
         # we deliberately do not check if intervals overlap
-        length = random.randint(*test_len_interval)
-        start = random.randint(0, point_data_3d.shape[1] - length)
+        length = rng.randint(*test_len_interval)
+        start = rng.randint(0, point_data_3d.shape[1] - length)
         point_data_3d[:, start:start + length] = np.nan
-
-    x, y, z, missing_indices = interpolate_missing(x, y, z, 'none')
-
-    x_lin, y_lin, z_lin, _ = interpolate_missing(x, y, z, 'linear')
-    x_gpr, y_gpr, z_gpr, _ = interpolate_missing(x, y, z, 'gpr', take, use)
-
-    # gt, lin and gpr points at the deleted indices
-    gt_points_miss = np.array([x_gt, y_gt, z_gt])[:, missing_indices]
-    lin_points_miss = np.array([x_lin, y_lin, z_lin])[:, missing_indices]
-    gpr_points_miss = np.array([x_gpr, y_gpr, z_gpr])[:, missing_indices]
-
-    absolute_error_lin = np.absolute(gt_points_miss - lin_points_miss).sum()
-    absolute_error_gpr = np.absolute(gt_points_miss - gpr_points_miss).sum()
-
-    avg_error_lin = absolute_error_lin / len(missing_indices)
-    avg_error_gpr = absolute_error_gpr / len(missing_indices)
+        raw_points[:, start:start + length] = np.nan
+
+    x, y, z, missing_indices = interpolate_missing(x, y, z, 'none', take)
+    gt_points = gt_points[:, ::take]
+    gaps = GapIndex(x[np.newaxis, np.newaxis]).gaps
+    random_state = rng.randrange(2**32) # for the optimizer restarts
+
+    results, predictions = {}, {}
+    for name in methods:
+        if name in PIPELINES:
+            stages = [(stage, dict(options, random_state=random_state) if options.get('method') == 'gpr' else options) for stage, options in PIPELINES[name]]
+            points, stats = run_method(*raw_points[:, ::take], 'pipeline', 1, stages=stages, kernels=kernels)
+            impute_options = [options for stage, options in PIPELINES[name] if stage == 'impute'][-1]
+            stats['fits'] = fits_per_marker(impute_options['method'], impute_options)
+        else:
+            method, method_use, options = METHODS[name]
+            if method == 'gpr': options = dict(options, kernels=kernels, random_state=random_state)
+            points, stats = run_method(x, y, z, method, method_use, **options)
+            stats['fits'] = fits_per_marker(method, options)
+        predictions[name] = points
+
+        # avg_error: absolute error summed over x, y and z, averaged over the deleted frames
+        error = points - gt_points
+        stats['error'] = float(np.absolute(error[:, missing_indices]).sum() / len(missing_indices))
+        stats['buckets'] = {label: [0, 0.0, 0.0] for label in GAP_BUCKETS}
+        for gap in gaps:
+            gap_error = error[:, gap['start']:gap['end'] + 1]
+            bucket = stats['buckets'][gap_bucket(gap['length'])]
+            bucket[0] += gap_error.size
+            bucket[1] += float(np.absolute(gap_error).sum())
+            bucket[2] += float(np.square(gap_error).sum())
+        results[name] = stats
 
     if DO_PLOT:
-        print('avg_error_lin', avg_error_lin)
-        print('avg_error_gpr', avg_error_gpr)
+        for name in methods:
+            print(f'avg_error_{name}', results[name]['error'])
 
         ax = plt.axes()
 
         for p in group_intervals(missing_indices):
             ax.axvspan(p[0], p[1], color='#ff8080', alpha=0.2)
         framecount = len(x)
-        ax.plot(range(framecount), x_gt, linewidth=2.0, label='x_gt', color='tab:blue', alpha=0.5)
-        ax.plot(range(framecount), y_gt, linewidth=2.0, label='y_gt', color='tab:blue', alpha=0.5)
-        ax.plot(range(framecount), z_gt, linewidth=2.0, label='z_gt', color='tab:blue', alpha=0.5)
-
-        ax.plot(range(framecount), x_lin, linewidth=2.0, label='x_lin', color='tab:orange', alpha=0.5)
-        ax.plot(range(framecount), y_lin, linewidth=2.0, label='y_lin', color='tab:orange', alpha=0.5)
-        ax.plot(range(framecount), z_lin, linewidth=2.0, label='z_lin', color='tab:orange', alpha=0.5)
-
-        ax.plot(range(framecount), x_gpr, linewidth=2.0, label='x_gpr', color='tab:green', alpha=0.5)
-        ax.plot(range(framecount), y_gpr, linewidth=2.0, label='y_gpr', color='tab:green', alpha=0.5)
-        ax.plot(range(framecount), z_gpr, linewidth=2.0, label='z_gpr', color='tab:green', alpha=0.5)
+        for label, points, color in [('gt', gt_points, 'tab:blue')] + [(name, predictions[name], f'C{i + 1}') for i, name in enumerate(methods)]:
+            for axis, values in zip('xyz', points):
+                ax.plot(range(framecount), values, linewidth=2.0, label=f'{axis}_{label}', color=color, alpha=0.5)
 
         # Label the axes
         ax.set_xlabel('Frames')
@@ -138,8 +294,55 @@ def test_keypoint(point_data_3d: np.array):
         plt.legend(loc='upper right')
         plt.show()
 
-    return avg_error_lin, avg_error_gpr
+    return results
+
+
+def run_method(x, y, z, method, method_use, **kwargs):
+    # impute one marker, measuring wall time and CPU time
+    # method 'pipeline' runs the stages of helper.pipeline (kwargs stages and kernels) on the marker instead
+    def run():
+        if method == 'pipeline':
+            kernels = kwargs['kernels']
+            points, _, _ = run_pipeline(np.array([x, y, z])[:, np.newaxis, :], ['marker'], kwargs['stages'], (lambda _: kernels) if kernels is not None else None)
+            return points[:, 0, :]
+        return interpolate_missing(x, y, z, method, 1, method_use, **kwargs)[:3] # x, y and z are decimated by `take` already
+
+    # the warm-start kernels as the first run finds them, as that run stores its learned kernels in them
+    start_kernels = snapshot_kernels(kwargs['kernels']) if kwargs.get('kernels') is not None else None
+    wall, cpu = time.perf_counter(), time.process_time()
+    x_imp, y_imp, z_imp = run()
+    stats = {'wall_s': time.perf_counter() - wall, 'cpu_s': time.process_time() - cpu, 'peak_mem_mb': np.nan}
+
+    if TRACE_MEMORY:
+        # tracing slows down every allocation, so the peak memory is measured in a second run, from the same warm start
+        if start_kernels is not None: kwargs['kernels'] = start_kernels
+        tracemalloc.start()
+        run()
+        stats['peak_mem_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return np.array([x_imp, y_imp, z_imp]), stats
+
+
+def snapshot_kernels(kernels):
+    # copy of the kernels of one marker (a dict or a gpr_cache.CacheView), keyed by axis
+    return {key: kernels[key] for key in ['x', 'y', 'z', 'xyz'] if key in kernels}
+
+
+def fits_per_marker(method, options):
+    # models fitted per marker: multi-output GPRs and the Kalman smoother fit x, y and z together
+    return 1 if method == 'kalman' or options.get('multi_output') else 3
+
+
+def gap_bucket(length):
+    # label of the longest bucket whose lower bound the gap reaches
+    return [label for label, shortest in GAP_BUCKETS.items() if length >= shortest][-1]
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Benchmark imputation methods on artificial gaps in complete markers")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes (default: 1)")
+    parser.add_argument('--no_resume', action='store_true', help=f"Discard the results in {RECORDS_PATH} and start over")
+    parser.add_argument('--methods', nargs='+', choices=list(METHODS) + list(PIPELINES), default=DEFAULT_METHODS, help=f"Methods to compare (default: {' '.join(DEFAULT_METHODS)})")
+    args = parser.parse_args()
+
+    main(args.workers, not args.no_resume, args.methods)
@@ -0,0 +1,111 @@
+import json
+import shutil
+import subprocess
+from pathlib import Path
+import numpy as np
+
+# Alignment of the video frames of both cameras (_c1, _c2) to the 3D joints of a trial
+#
+# Every video frame k is mapped by its timestamp to a position between two joint frames i0 and i1:
+#   pose(k) = (1 - weight[k]) * joints[i0[k]] + weight[k] * joints[i1[k]]
+# valid[k] is False for video frames before the first or after the last joint frame.
+# The index is computed once per trial and saved as <name>.align.npz next to the joints (see osim_to_json.py),
+# so loaders look up the pose of a frame instead of recomputing the alignment.
+
+CAMERAS = ['c1', 'c2']
+VIDEO_FPS = 50 # nominal frame rate of the videos, used when ffprobe is not available
+
+
+def alignment_path(joints_path):
+    return Path(joints_path).with_suffix('.align.npz')
+
+
+def video_path(video_dir, trial_name, camera):
+    # e.g. S1/videos/s1_drinking_normal_c1.mp4, as named by rename_mp4s.ps1
+    return Path(video_dir, f'{trial_name}_{camera}.mp4')
+
+
+def video_info(path):
+    """(fps, n_frames) of a video, read with ffprobe without decoding it. None if ffprobe is not installed or fails"""
+    if shutil.which('ffprobe') is None or not Path(path).is_file():
+        return None
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=avg_frame_rate,nb_frames,duration', '-of', 'json', str(path)]
+    try:
+        stream = json.loads(subprocess.run(command, capture_output=True, text=True, check=True).stdout)['streams'][0]
+        numerator, denominator = stream['avg_frame_rate'].split('/')
+        fps = float(numerator) / float(denominator)
+        if 'nb_frames' in stream:
+            n_frames = int(stream['nb_frames'])
+        else:
+            n_frames = int(round(float(stream['duration']) * fps))
+    except (subprocess.CalledProcessError, KeyError, IndexError, ValueError, ZeroDivisionError):
+        return None
+    return fps, n_frames
+
+
+def align_frames(joint_times, video_fps, n_video_frames, offset=0.0):
+    """(i0, i1, weight, valid) of every video frame, for joint frames captured at joint_times (in seconds)
+
+    - offset: time of the first video frame after the first joint frame, in seconds
+    """
+    joint_times = np.asarray(joint_times, dtype=float)
+    frame_times = joint_times[0] + offset + np.arange(n_video_frames) / video_fps
+    # fractional joint frame of every video frame, also for non uniform joint times
+    position = np.interp(frame_times, joint_times, np.arange(len(joint_times)))
+    position = np.where(np.isclose(position, np.round(position), atol=1e-4), np.round(position), position) # exact joint frames without interpolation
+
+    i0 = np.floor(position).astype(np.int32)
+    i1 = np.minimum(i0 + 1, len(joint_times) - 1).astype(np.int32)
+    weight = (position - i0).astype(np.float32)
+    tolerance = 0.5 / video_fps # half a video frame
+    valid = (frame_times >= joint_times[0] - tolerance) & (frame_times <= joint_times[-1] + tolerance)
+    return i0, i1, weight, valid
+
+
+def trial_alignment(joint_times, video_dir, trial_name, offset=0.0):
+    """Alignment of both cameras of a trial, {camera: (i0, i1, weight, valid, fps)}, and where the frame rates came from
+
+    Without ffprobe or a video, the camera is assumed to run at VIDEO_FPS over the duration of the joints.
+    """
+    alignments, sources = {}, {}
+    for camera in CAMERAS:
+        info = video_info(video_path(video_dir, trial_name, camera)) if video_dir is not None else None
+        if info is None:
+            duration = joint_times[-1] - joint_times[0]
+            info = VIDEO_FPS, int(np.floor(duration * VIDEO_FPS + 1e-6)) + 1
+            sources[camera] = 'nominal'
+        else:
+            sources[camera] = 'ffprobe'
+        alignments[camera] = (*align_frames(joint_times, *info, offset), info[0])
+    return alignments, sources
+
+
+def write_alignment(path, joint_times, alignments, sources):
+    arrays = {'joint_times': np.asarray(joint_times, dtype=float)}
+    for camera, (i0, i1, weight, valid, fps) in alignments.items():
+        arrays.update({f'{camera}_i0': i0, f'{camera}_i1': i1, f'{camera}_weight': weight, f'{camera}_valid': valid, f'{camera}_fps': np.float64(fps)})
+    arrays['sources'] = np.array(json.dumps(sources))
+    np.savez(path, **arrays)
+
+
+def load_alignment(path):
+    """{camera: {'i0', 'i1', 'weight', 'valid', 'fps'}} of a trial"""
+    with np.load(path) as data:
+        return {camera: {key: data[f'{camera}_{key}'] for key in ['i0', 'i1', 'weight', 'valid', 'fps']}
+                for camera in CAMERAS if f'{camera}_i0' in data}
+
+
+def aligned_pose(joints, alignment, camera, frame):
+    """(n_markers, 3) pose at video frame `frame` of `camera`, interpolated between the two nearest joint frames"""
+    a = alignment[camera]
+    if not a['valid'][frame]:
+        raise IndexError(f'Video frame {frame} of camera {camera} is outside of the captured joints')
+    i0, i1, weight = a['i0'][frame], a['i1'][frame], float(a['weight'][frame])
+    if weight == 0:
+        return np.array(joints[i0])
+    return (1 - weight) * np.asarray(joints[i0], dtype=float) + weight * np.asarray(joints[i1], dtype=float)
+
+
+def aligned_frames(alignment, camera):
+    # video frames of `camera` that have a pose, e.g. the frames worth extracting from the video
+    return np.nonzero(alignment[camera]['valid'])[0]
@@ -0,0 +1,54 @@
+import json
+import traceback
+from contextlib import contextmanager
+from os import replace
+from pathlib import Path
+from tqdm import tqdm
+
+# Shared by the batch scripts in preprocessing/ (fix_c3d_folder.py, extract_frames.py, detect_corrupt.py, qc_report.py,
+# export_dataset.py): listing their input files, recording the error of a file instead of stopping the run, and the
+# manifest with the outcome of every file that lets a later run skip or retry files.
+
+
+def collect_c3d_files(dirs, unique=None):
+    """The .c3d files in the folders `dirs`, sorted by name within every folder
+
+    unique ('name' or 'stem') raises a ValueError if two files share it, e.g. as their outputs go to the same folder
+    """
+    files = [path for d in dirs for path in sorted(Path(d).iterdir()) if path.is_file() and path.suffix.lower() == '.c3d']
+    if unique:
+        keys = [getattr(f, unique) for f in files]
+        duplicates = {key for key in keys if keys.count(key) > 1}
+        if duplicates:
+            raise ValueError(f'Multiple input files have the same {unique}: {sorted(duplicates)}')
+    return files
+
+
+@contextmanager
+def record_error(entry):
+    # report the error in entry instead of raising, so one bad file does not stop the run. An entry with a status is
+    # marked failed
+    try:
+        yield entry
+    except Exception as e:
+        if 'status' in entry: entry['status'] = 'failed'
+        entry['error'] = f'{type(e).__name__}: {e}'
+        entry['traceback'] = traceback.format_exc()
+
+
+def load_manifest(manifest_path: Path):
+    if not manifest_path.is_file():
+        return {}
+    with open(manifest_path) as file:
+        return json.load(file)
+
+
+def update_manifest(manifest, manifest_path: Path, results, total):
+    # results are (name, entry) pairs, e.g. from executor.map
+    for name, entry in tqdm(results, total=total):
+        manifest[name] = entry
+        # save after every file, so an interrupted run resumes with the remaining ones
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(manifest, file, indent=4)
+        replace(tmp_path, manifest_path)
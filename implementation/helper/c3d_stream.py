@@ -0,0 +1,174 @@
+import os
+import struct
+import numpy as np
+from .util import NUM_MARKERS
+
+# Reading and writing the points of a c3d file a chunk of frames at a time, without loading the whole trial
+#
+# Only the layout of the MPC captures is supported: Intel byte order and float data (POINT:SCALE < 0).
+# The data section is then a float32 array of n_frames rows of [x, y, z, residual] per point, followed by the analog samples,
+# which is memory mapped. Points with a negative residual were not captured and are NaN, like in ezc3d.
+# Everything else can be read with ezc3d (helper/util.Trial).
+
+BLOCK_SIZE = 512
+INTEL = 84
+DTYPES = {-1: 'S1', 1: 'i1', 2: '<i2', 4: '<f4'} # c3d parameter types: char, byte, int16, float
+
+
+class C3DReader:
+    """Header and parameters of a c3d file, and its points read lazily by frame"""
+
+    def __init__(self, c3d_file_path):
+        self.path = str(c3d_file_path)
+        with open(self.path, 'rb') as file:
+            header = file.read(BLOCK_SIZE)
+            parameter_block = header[0]
+            n_points, n_analog, first_frame, last_frame = struct.unpack('<4H', header[2:10])
+            scale, = struct.unpack('<f', header[12:16])
+            data_block, = struct.unpack('<H', header[16:18])
+
+            file.seek((parameter_block - 1) * BLOCK_SIZE)
+            section = file.read(BLOCK_SIZE)
+            n_blocks, processor = section[2], section[3]
+            if processor != INTEL:
+                raise NotImplementedError(f'{self.path}: only c3d files in Intel byte order can be streamed')
+            section += file.read((n_blocks - 1) * BLOCK_SIZE)
+        if scale >= 0:
+            raise NotImplementedError(f'{self.path}: only c3d files with float data can be streamed')
+
+        self.parameters = parse_parameters(section[4:])
+        self.n_points = n_points
+        self.n_frames = frame_count(self.parameters, last_frame - first_frame + 1)
+        self.rate = float(self.parameters['POINT']['RATE'][0])
+        self.labels = [label for key in ['LABELS', 'LABELS2', 'LABELS3'] for label in self.parameters['POINT'].get(key, [])][:n_points]
+        self.marker_names = self.labels[:NUM_MARKERS]
+
+        # one row per frame: n_points * [x, y, z, residual], then the analog samples of the frame
+        self.data_offset = (data_block - 1) * BLOCK_SIZE
+        self.frame_size = 4 * n_points + n_analog
+        padding = os.path.getsize(self.path) - self.data_offset - self.n_frames * self.frame_size * 4
+        if not 0 <= padding <= BLOCK_SIZE: # the data section ends in at most one block of padding
+            raise NotImplementedError(f'{self.path}: {self.n_frames} frames do not match the size of the data section')
+        self.data = np.memmap(self.path, dtype='<f4', mode='r', offset=self.data_offset, shape=(self.n_frames, self.frame_size))
+
+    def points(self, start=0, stop=None):
+        """(3, n_points, stop - start) points of the frames start..stop-1, only these frames are read from disk"""
+        frames = np.array(self.data[start:stop, :4 * self.n_points]).reshape(-1, self.n_points, 4)
+        points = frames[..., :3].transpose(2, 1, 0).astype(float)
+        points[:, (frames[..., 3] < 0).T] = np.nan
+        return points
+
+    def chunks(self, chunk_frames, context=0):
+        """(start, stop, points) of consecutive chunks of frames, points includes `context` frames before and after the chunk
+
+        points[..., start - first:stop - first] are the frames of the chunk itself, with first = max(start - context, 0).
+        """
+        for start in range(0, self.n_frames, chunk_frames):
+            stop = min(start + chunk_frames, self.n_frames)
+            yield start, stop, self.points(max(start - context, 0), min(stop + context, self.n_frames))
+
+
+def can_stream(c3d_file_path):
+    # whether C3DReader supports the layout of the file
+    try:
+        C3DReader(c3d_file_path)
+    except NotImplementedError:
+        return False
+    return True
+
+
+class C3DWriter:
+    """Writes a c3d file with the header, parameters and analog data of `reader` and new points, a chunk of frames at a time"""
+
+    def __init__(self, out_path, reader: C3DReader):
+        self.reader = reader
+        self.frame = 0
+        self.file = open(out_path, 'wb')
+        with open(reader.path, 'rb') as source:
+            self.file.write(source.read(reader.data_offset))
+
+    def write(self, points):
+        # (3, n_points, n) points of the next n frames, NaN for points that were not captured
+        n = points.shape[-1]
+        if self.frame + n > self.reader.n_frames:
+            raise ValueError(f'{self.frame + n} frames written, the trial has {self.reader.n_frames}')
+        frames = np.array(self.reader.data[self.frame:self.frame + n]) # the analog samples are copied
+        xyzr = frames[:, :4 * self.reader.n_points].reshape(n, -1, 4)
+        missing = np.isnan(points).any(axis=0).T
+        xyzr[..., :3] = np.nan_to_num(points.transpose(2, 1, 0))
+        xyzr[..., 3] = np.where(missing, -1, 0) # residual -1: not captured, 0: unknown residual
+        self.file.write(frames.astype('<f4').tobytes())
+        self.frame += n
+
+    def close(self):
+        if self.frame != self.reader.n_frames:
+            self.file.close()
+            raise ValueError(f'{self.frame} of {self.reader.n_frames} frames written')
+        # anything after the data (padding to the next block) is copied as well
+        with open(self.reader.path, 'rb') as source:
+            source.seek(self.reader.data_offset + self.reader.n_frames * self.reader.frame_size * 4)
+            self.file.write(source.read())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+def frame_count(parameters, header_frames):
+    """Number of frames, like ezc3d: the header holds at most 65535, longer trials store it in TRIAL or POINT:FRAMES"""
+    trial = parameters.get('TRIAL', {})
+    if 'ACTUAL_START_FIELD' in trial and 'ACTUAL_END_FIELD' in trial:
+        # two unsigned 16 bit words each, stored as int16: low word, high word
+        start, end = [int(trial[name][0]) & 0xFFFF | (int(trial[name][1]) & 0xFFFF) << 16 for name in ['ACTUAL_START_FIELD', 'ACTUAL_END_FIELD']]
+        return end - start + 1
+    frames = parameters.get('POINT', {}).get('FRAMES')
+    if frames is not None and len(frames):
+        return int(frames[0]) & 0xFFFF if frames.dtype.kind == 'i' else int(frames[0]) # float for more than 65535 frames
+    return header_frames
+
+
+def parse_parameters(section):
+    """{group: {parameter: value}} of the parameter section (without its 4 byte header)
+
+    Values are numpy arrays, char parameters lists of strings (or a string, if one-dimensional).
+    """
+    groups, parameters = {}, []
+    position = 0
+    while position < len(section):
+        n_chars, group_id = struct.unpack('<bb', section[position:position + 2])
+        if n_chars == 0: break
+        name = section[position + 2:position + 2 + abs(n_chars)].decode('ascii', errors='replace')
+        position += 2 + abs(n_chars)
+        offset, = struct.unpack('<h', section[position:position + 2])
+
+        if group_id < 0:
+            groups[-group_id] = name
+        else:
+            data_type, n_dims = struct.unpack('<bB', section[position + 2:position + 4])
+            dims = list(section[position + 4:position + 4 + n_dims])
+            start = position + 4 + n_dims
+            count = int(np.prod(dims)) if n_dims else 1
+            value = np.frombuffer(section, dtype=DTYPES[data_type], count=count, offset=start)
+            if data_type == -1:
+                # the first dimension is the length of the strings
+                n_strings = int(np.prod(dims[1:])) if n_dims > 1 else 1
+                strings = value.reshape(n_strings, -1) if count else np.empty((n_strings, 0), dtype='S1')
+                value = [b''.join(s).decode('ascii', errors='replace').strip() for s in strings]
+                if n_dims <= 1: value = value[0]
+            elif n_dims > 1:
+                value = value.reshape(dims, order='F') # the first dimension changes fastest
+            parameters.append((group_id, name, value))
+
+        if offset == 0: break
+        position += offset
+
+    result = {name: {} for name in groups.values()}
+    for group_id, name, value in parameters:
+        result.setdefault(groups.get(group_id, str(group_id)), {})[name] = value
+    return result
@@ -0,0 +1,123 @@
+import json
+from pathlib import Path
+import numpy as np
+from numpy.lib.format import open_memmap
+from .util import load_trial, parse_trial_name
+
+# One store for the preprocessed trials of the whole dataset, so consumers read the frames they need without parsing c3d files
+#
+# <store>/points.npy    float32 (n_frames, n_markers, 3), the frames of all trials one after the other
+# <store>/observed.npy  bool (n_frames, n_markers), frames based on captured data
+# <store>/imputed.npy   bool (n_frames, n_markers), frames filled by the interpolation
+# <store>/std.npy       float32 (n_frames, n_markers, 3), std of the GPR / Kalman smoother at the frames it predicted
+#                       (the imputed frames, and the captured frames left out with use > 1), NaN elsewhere
+# <store>/index.json    marker labels, and subject, action, variation, rate and frames [start, stop) of every trial
+
+ARRAYS = ['points', 'observed', 'imputed', 'std']
+INDEX_NAME = 'index.json'
+
+
+def imputation_path(c3d_file_path):
+    # written by fix_c3d_folder next to every preprocessed c3d file
+    return Path(c3d_file_path).with_suffix('.imputation.npz')
+
+
+def write_imputation(path, observed, imputed, std):
+    # observed and imputed are (n_markers, n_frames) masks, std is (3, n_markers, n_frames) like the c3d points
+    np.savez_compressed(path, observed=observed, imputed=imputed, std=np.asarray(std, dtype=np.float32)) # no copy if std is float32 already
+
+
+def read_imputation(c3d_file_path, points):
+    """observed, imputed and std of a preprocessed trial, in the layout of the store
+
+    Trials without a sidecar file (e.g. preprocessed by an older version) count every captured frame as observed.
+    """
+    path = imputation_path(c3d_file_path)
+    if path.is_file():
+        with np.load(path) as imputation:
+            return imputation['observed'].T, imputation['imputed'].T, imputation['std'].transpose(2, 1, 0)
+    observed = ~np.isnan(points).any(axis=-1)
+    return observed, np.zeros_like(observed), np.full(points.shape, np.nan, dtype=np.float32)
+
+
+def export_dataset(c3d_paths, store_dir):
+    """Consolidate the preprocessed trials `c3d_paths` into the store `store_dir`
+
+    Trials not named <subject>_<action>_<variation> are stored with subject, action and variation None.
+    """
+    c3d_paths = list(c3d_paths)
+    if len(c3d_paths) == 0:
+        raise ValueError('No trials to export')
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+
+    # the trials are small compared to the memory of the machine, the whole dataset is a few hundred MB at most
+    labels, trials, arrays = None, [], {name: [] for name in ARRAYS}
+    start = 0
+    for c3d_path in c3d_paths:
+        trial = load_trial(c3d_path)
+        if labels is None:
+            labels = list(trial.marker_names)
+        elif list(trial.marker_names) != labels:
+            raise ValueError(f'{c3d_path} has different marker labels than {c3d_paths[0]}')
+
+        points = trial.points[:, :len(labels), :].transpose(2, 1, 0).astype(np.float32)
+        observed, imputed, std = read_imputation(c3d_path, points)
+        for name, array in zip(ARRAYS, [points, observed, imputed, std]):
+            arrays[name].append(array)
+
+        try:
+            subject, action, variation = parse_trial_name(c3d_path)
+        except ValueError:
+            subject, action, variation = None, None, None # still found by name, see DatasetStore.trial
+        name = Path(c3d_path).stem
+        trials.append({'name': name, 'subject': subject, 'action': action, 'variation': variation,
+                       'rate': trial.rate, 'start': start, 'stop': start + len(points)})
+        start += len(points)
+
+    for name, parts in arrays.items():
+        array = open_memmap(store_dir / f'{name}.npy', mode='w+', dtype=parts[0].dtype, shape=(start, *parts[0].shape[1:]))
+        offset = 0
+        for part in parts:
+            array[offset:offset + len(part)] = part
+            offset += len(part)
+        array.flush()
+        del array
+
+    index = {'labels': labels, 'n_frames': start, 'trials': trials}
+    with open(store_dir / INDEX_NAME, 'w') as file:
+        json.dump(index, file, indent=4)
+    return index
+
+
+class DatasetStore:
+    """Read access to a store written by export_dataset. The arrays are memory mapped, so slicing reads only those frames."""
+
+    def __init__(self, store_dir):
+        self.path = Path(store_dir)
+        with open(self.path / INDEX_NAME) as file:
+            self.index = json.load(file)
+        self._arrays = {}
+
+    @property
+    def labels(self):
+        return self.index['labels']
+
+    def array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(self.path / f'{name}.npy', mmap_mode='r')
+        return self._arrays[name]
+
+    def trials(self, subject=None, action=None, variation=None):
+        # index entries of the matching trials, e.g. trials(action='drinking')
+        return [t for t in self.index['trials']
+                if (subject is None or t['subject'] == subject)
+                and (action is None or t['action'] == action)
+                and (variation is None or t['variation'] == variation)]
+
+    def trial(self, name, array='points'):
+        # frames of one trial (a memory mapped view)
+        entries = [t for t in self.index['trials'] if t['name'] == name]
+        if len(entries) == 0: raise KeyError(f'No trial {name!r} in {self.path}')
+        entry = entries[0]
+        return self.array(array)[entry['start']:entry['stop']]
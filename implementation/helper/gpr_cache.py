@@ -0,0 +1,129 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from os import replace
+from pathlib import Path
+import numpy as np
+from .interpolate import kernel
+
+# Persistent cache of learned GPR hyperparameters, used to warm-start the optimizer (see fit_predict_gpr)
+# Entries are keyed by (subject, action, marker, axis), as the optimal length scales hardly change
+# between the trials (variations) of the same subject and action.
+
+class HyperparameterCache:
+    """Learned kernel hyperparameters (kernel.theta) stored in a json file.
+
+    Least recently used entries are evicted once there are more than `max_entries`,
+    entries older than `max_age_days` are dropped when loading.
+    """
+
+    def __init__(self, path, max_entries=10000, max_age_days=None):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.entries = self._read()
+
+    def _read(self):
+        if not self.path.is_file():
+            return {}
+        with open(self.path) as file:
+            entries = json.load(file)
+        if self.max_age_days is not None:
+            min_used = time.time() - self.max_age_days * 24 * 3600
+            entries = {key: entry for key, entry in entries.items() if entry['used'] >= min_used}
+        return entries
+
+    def get(self, subject, action, marker, axis):
+        entry = self.entries.get(self._key(subject, action, marker, axis))
+        if entry is None:
+            return None
+        entry['used'] = time.time()
+        return kernel.clone_with_theta(np.array(entry['theta']))
+
+    def set(self, subject, action, marker, axis, learned_kernel):
+        self.entries[self._key(subject, action, marker, axis)] = {'theta': learned_kernel.theta.tolist(), 'used': time.time()}
+
+    def view(self, subject, action, marker):
+        # dict-like access by axis, as expected by the `kernels` argument of the gpr methods
+        return CacheView(self, subject, action, marker)
+
+    def save(self):
+        # Merge with entries other processes saved in the meantime (the most recently used entry wins),
+        # evict, and replace the file atomically. The lock keeps other processes from replacing the file
+        # between the read and the replace, which would drop their entries.
+        with file_lock(self.path):
+            on_disk = self._read()
+            for key, entry in on_disk.items():
+                if key not in self.entries or self.entries[key]['used'] < entry['used']:
+                    self.entries[key] = entry
+            if len(self.entries) > self.max_entries:
+                newest = sorted(self.entries.items(), key=lambda item: item[1]['used'])[-self.max_entries:]
+                self.entries = dict(newest)
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(f'.{time.time_ns()}.tmp')
+            with open(tmp_path, 'w') as file:
+                json.dump(self.entries, file, indent=4)
+            replace(tmp_path, self.path)
+
+    @staticmethod
+    def _key(subject, action, marker, axis):
+        return f'{subject}/{action}/{marker}/{axis}'
+
+
+@contextmanager
+def file_lock(path, timeout=60, stale_after=600):
+    # exclusive lock of `path` by a <path>.lock file, created atomically with O_EXCL (also on Windows).
+    # A lock older than stale_after seconds was left behind by a killed process and is removed.
+    lock_path = Path(f'{path}.lock')
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - lock_path.stat().st_mtime > stale_after:
+                    lock_path.unlink()
+                    continue
+            except FileNotFoundError:
+                continue # released meanwhile
+            if time.time() > deadline:
+                raise TimeoutError(f'{lock_path} is held by another process, delete it if none is running')
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        lock_path.unlink(missing_ok=True)
+
+
+class CacheView:
+    """The entries of one marker of a HyperparameterCache, keyed by axis ('x', 'y', 'z' or 'xyz')"""
+
+    def __init__(self, cache, subject, action, marker):
+        self.cache = cache
+        self.subject = subject
+        self.action = action
+        self.marker = marker
+        self._kernels = {} # looked up once per view
+
+    def _lookup(self, axis):
+        if axis not in self._kernels:
+            self._kernels[axis] = self.cache.get(self.subject, self.action, self.marker, axis)
+        return self._kernels[axis]
+
+    def __contains__(self, axis):
+        return self._lookup(axis) is not None
+
+    def __getitem__(self, axis):
+        learned_kernel = self._lookup(axis)
+        if learned_kernel is None:
+            raise KeyError(axis)
+        return learned_kernel
+
+    def __setitem__(self, axis, learned_kernel):
+        self._kernels[axis] = learned_kernel
+        self.cache.set(self.subject, self.action, self.marker, axis, learned_kernel)
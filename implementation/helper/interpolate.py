@@ -1,37 +1,93 @@
+import warnings
 import numpy as np
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import Matern, ConstantKernel
+from sklearn.exceptions import ConvergenceWarning
 import numpy.polynomial.polynomial as poly
+from scipy.optimize import minimize
+from .util import GapIndex, gap_table, group_intervals
+from .statespace import smooth_matern32
+from . import profiling
 
 # Different methods for interpolating / imputing missing data
 
-def interpolate_missing(x, y, z, method, take=1, use=1):
-    missing_indices = np.where(np.isnan(x))[0]
-    x = np.array([elem if i % use == 0 else np.nan for (i, elem) in enumerate(x)])[::take]
-    y = np.array([elem if i % use == 0 else np.nan for (i, elem) in enumerate(y)])[::take]
-    z = np.array([elem if i % use == 0 else np.nan for (i, elem) in enumerate(z)])[::take]
-
-    match method:
-        case 'none':
-            pass
-        case 'linear':
-            x, y, z = interpolate_nan_linear(x, y, z)
-        case 'polynomial':
-            x, y, z = interpolate_nan_polynomial(x, y, z)
-        case 'gpr':
-            x, y, z = interpolate_nan_gpr(x, y, z)
+def interpolate_missing(x, y, z, method, take=1, use=1, return_std=False, **kwargs):
+    # method is the name of a registered imputer (see IMPUTERS), kwargs are passed on to it
+    # missing_indices are the frames missing in the capture, as indices into the returned (decimated) arrays
+    # with return_std, the (3, n_frames) std of the imputed frames is returned as well (for gpr and kalman)
+    missing = np.isnan(x)
+    points, _, frame_index = decimate(np.array([x, y, z])[:, np.newaxis, :], take, use)
+    missing_indices = np.nonzero(missing[frame_index])[0]
+
+    if 'kernels' in kwargs: kwargs['kernels'] = [kwargs['kernels']] # one per marker
+    if return_std: kwargs['return_std'] = True
+    points, std = impute(points, method, **kwargs)
+    x, y, z = points[:, 0, :]
+    if return_std:
+        return x, y, z, missing_indices, std[:, 0, :]
     return x, y, z, missing_indices
 
 
+def decimate(points, take=1, use=1):
+    """Decimate the frames (last axis) of e.g. x or the whole (3, n_markers, n_frames) point array
+
+    Every `take`th frame is kept, of those only the frames with an index divisible by `use` keep their value,
+    the others are set to NaN (to be imputed). Returns the decimated copy, the mask of the frames set to NaN
+    and the original index of every returned frame.
+    """
+    frame_index = np.arange(0, points.shape[-1], take)
+    mask = frame_index % use != 0
+    decimated = np.array(points[..., ::take], dtype=float)
+    decimated[..., mask] = np.nan
+    return decimated, mask, frame_index
+
+
 def interpolate_nan_linear(x, y, z):
     # interpolate x, y, and z coordinates
-    nonz_idcs = lambda l: l.nonzero()[0]
-    x[np.isnan(x)] = np.interp(nonz_idcs(np.isnan(x)), nonz_idcs(~np.isnan(x)), x[~np.isnan(x)])
-    y[np.isnan(y)] = np.interp(nonz_idcs(np.isnan(y)), nonz_idcs(~np.isnan(y)), y[~np.isnan(y)])
-    z[np.isnan(z)] = np.interp(nonz_idcs(np.isnan(z)), nonz_idcs(~np.isnan(z)), z[~np.isnan(z)])
+    points, _ = interpolate_nan_linear_batch(np.array([x, y, z])[:, np.newaxis, :])
+    x, y, z = points[:, 0, :]
     return x, y, z
 
 
+def interpolate_nan_linear_batch(points):
+    """Linearly interpolate every gap of a (3, n_markers, n_frames) array in one pass.
+
+    Like np.interp, leading and trailing gaps take the nearest captured value. Axes of a marker
+    without any captured value stay NaN. Returns the filled copy and statistics about the gaps.
+    """
+    points = np.array(points, dtype=float)
+    missing = np.isnan(points)
+    gaps = gap_table(missing)
+
+    # index of the previous and next captured frame, for every frame
+    n_frames = points.shape[-1]
+    frames = np.arange(n_frames)
+    prev_idx = np.maximum.accumulate(np.where(missing, -1, frames), axis=-1)
+    next_idx = np.minimum.accumulate(np.where(missing, n_frames, frames)[..., ::-1], axis=-1)[..., ::-1]
+    has_prev = prev_idx >= 0
+    has_next = next_idx < n_frames
+
+    fill = missing & (has_prev | has_next)
+    axis_idx, marker_idx, frame_idx = np.nonzero(fill)
+    left = np.where(has_prev, prev_idx, next_idx)[fill]
+    right = np.where(has_next, next_idx, prev_idx)[fill]
+    left_val = points[axis_idx, marker_idx, left]
+    right_val = points[axis_idx, marker_idx, right]
+    weight = np.divide(frame_idx - left, right - left, out=np.zeros(len(left)), where=right > left)
+    points[fill] = left_val + weight * (right_val - left_val)
+
+    stats = {
+        'gaps': gaps,
+        'num_gaps': len(gaps),
+        'num_missing': int(missing.sum()),
+        'num_unfilled': int((missing & ~fill).sum()),
+        'max_length': int(gaps['length'].max(initial=0)),
+        'mean_length': float(gaps['length'].mean()) if len(gaps) else 0.0,
+        'gaps_per_marker': np.bincount(gaps['marker'], minlength=points.shape[1]),
+    }
+    return points, stats
+
+
 def interpolate_nan_polynomial(x, y, z, deg=80):
     nonz_idcs = lambda l: l.nonzero()[0]
     bad_indices = nonz_idcs(np.isnan(x))
@@ -48,54 +104,205 @@ def interpolate_nan_polynomial(x, y, z, deg=80):
 
 
 kernel = ConstantKernel(1000.0, (1e-3, 1e3)) * Matern(0.01, (1e-3, 1e3), 1.5)
-def interpolate_nan_gpr(x, y, z):
-    """Interpolate using sklearn Gaussian Process Regressor"""
+def interpolate_nan_gpr(x, y, z, window=None, multi_output=False, kernels=None, random_state=None, return_std=False):
+    """Interpolate using sklearn Gaussian Process Regressor
+
+    By default one GP is fitted on every captured frame of the trial. With `window` (in frames), the gaps
+    are fitted separately, each on the captured frames at most `window` frames before and after it.
+    With `multi_output`, x, y and z are fitted as one (n, 3) target that shares the kernel hyperparameters.
+    `kernels` (see fit_predict_gpr) shares the learned hyperparameters with later calls, e.g. neighbouring markers.
+    `random_state` seeds the optimizer restarts, for reproducible results.
+    With `return_std`, the predictive standard deviations of x, y and z are returned as well (NaN at the captured frames).
+    """
     good_indices = np.nonzero(~np.isnan(y))[0]
     bad_indices = np.nonzero(np.isnan(y))[0]
-    if len(bad_indices) == 0 or len(good_indices) == 0: return x, y, z
+    std = np.full((3, len(x)), np.nan)
+    if len(bad_indices) == 0 or len(good_indices) == 0: return (x, y, z, *std) if return_std else (x, y, z)
+
+    if window is None:
+        windows = [(good_indices, bad_indices)]
+    else:
+        windows = []
+        for start, end in gap_clusters(bad_indices, window):
+            context = good_indices[(good_indices >= start - window) & (good_indices <= end + window)]
+            if len(context) == 0: context = good_indices # gap too long for its window, use the whole trial
+            windows.append((context, bad_indices[(bad_indices >= start) & (bad_indices <= end)]))
+
+    for good, bad in windows:
+        if multi_output:
+            xyz = np.column_stack([x[good], y[good], z[good]])
+            prediction = fit_predict_gpr(good, xyz, bad, kernels, 'xyz', return_std, random_state)
+            if return_std: prediction, std[:, bad] = prediction[0], prediction[1].T
+            x[bad], y[bad], z[bad] = prediction.T
+        else:
+            for axis, (key, values) in enumerate(zip('xyz', (x, y, z))):
+                prediction = fit_predict_gpr(good, values[good], bad, kernels, key, return_std, random_state)
+                if return_std: prediction, std[axis, bad] = prediction
+                values[bad] = prediction
+
+    return (x, y, z, *std) if return_std else (x, y, z)
+
+
+def fit_predict_gpr(good_indices, values, pred_indices, kernels=None, key=None, return_std=False, random_state=None):
+    """Fit a GPR on the captured frames and predict the frames `pred_indices`.
 
+    values has shape (n,) or (n, k). The k outputs of a 2D target are solved with one kernel matrix and one
+    Cholesky factorization. If `kernels` (a dict) holds a kernel for `key`, the optimizer starts from it without
+    random restarts, unless that fit does not converge. The learned kernel is stored back under `key`.
+    """
     X = good_indices.reshape(-1, 1)
+    gpr = None
+    if kernels is not None and key in kernels:
+        gpr = GaussianProcessRegressor(kernels[key], optimizer=lbfgs, n_restarts_optimizer=0, alpha=1e-10, normalize_y=True)
+        if not fit_converged(gpr, X, values):
+            gpr = None # fall back to the cold start
+    if gpr is None:
+        gpr = GaussianProcessRegressor(kernel, optimizer=lbfgs, n_restarts_optimizer=10, alpha=1e-10, normalize_y=True, random_state=random_state)
+        gpr.fit(X, values)
 
-    gpr = GaussianProcessRegressor(kernel, n_restarts_optimizer=10, alpha=1e-10, normalize_y=True)
+    if kernels is not None:
+        kernels[key] = gpr.kernel_
+    return gpr.predict(pred_indices.reshape(-1, 1), return_std=return_std)
 
-    x[bad_indices] = gpr \
-        .fit(X, x[good_indices].reshape(-1, 1)) \
-        .predict(bad_indices.reshape(-1, 1)).T
 
-    y[bad_indices] = gpr \
-        .fit(X, y[good_indices].reshape(-1, 1)) \
-        .predict(bad_indices.reshape(-1, 1)).T
+def lbfgs(obj_func, initial_theta, bounds):
+    # the default optimizer of GaussianProcessRegressor, which also counts its iterations for the profiling
+    result = minimize(obj_func, initial_theta, method='L-BFGS-B', jac=True, bounds=bounds)
+    if not result.success:
+        warnings.warn(f'lbfgs failed to converge: {result.message}', ConvergenceWarning)
+    profiling.count(optimizer_runs=1, optimizer_iterations=result.nit, optimizer_evaluations=result.nfev)
+    return result.x, result.fun
 
-    z[bad_indices] = gpr \
-        .fit(X, z[good_indices].reshape(-1, 1)) \
-        .predict(bad_indices.reshape(-1, 1)).T
 
+def fit_converged(gpr, X, values):
+    # Fit and check that the optimizer converged to hyperparameters inside their bounds
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', ConvergenceWarning)
+        gpr.fit(X, values)
+    if any(issubclass(w.category, ConvergenceWarning) for w in caught):
+        return False
+    bounds = gpr.kernel_.bounds
+    return not np.any(np.isclose(gpr.kernel_.theta, bounds[:, 0]) | np.isclose(gpr.kernel_.theta, bounds[:, 1]))
+
+
+def interpolate_nan_kalman(x, y, z, return_std=False):
+    """Same model as interpolate_nan_gpr(multi_output=True), in O(n) instead of O(n^3)
+
+    The Matern-3/2 kernel has an exact state-space form, so the GP posterior is computed with a
+    Kalman filter and smoother over all frames (see helper/statespace.py).
+    """
+    good = ~np.isnan(y)
+    if good.all() or not good.any():
+        return (x, y, z, *np.zeros((3, len(x)))) if return_std else (x, y, z)
+
+    mean, std = smooth_matern32(np.column_stack([x, y, z]), good)
+    bad = ~good
+    x[bad], y[bad], z[bad] = mean[bad].T
+    if return_std:
+        x_std, y_std, z_std = std.T
+        return x, y, z, x_std, y_std, z_std
     return x, y, z
 
 
-def interpolate_nan_gpr_uncertainty(x, y, z):
-    good_indices = np.nonzero(~np.isnan(x))[0]
-    bad_indices = np.nonzero(np.isnan(x))[0]
+def gap_clusters(bad_indices, window):
+    # Gaps (from group_intervals) that are less than `window` frames apart are fitted together, as their
+    # context windows overlap anyway. A cluster is closed once it spans `window` frames, so the many short
+    # gaps left by decimation (use > 1) still result in fits of bounded size.
+    clusters = []
+    for start, end in group_intervals(bad_indices):
+        if clusters and start - clusters[-1][1] <= window and end - clusters[-1][0] < window:
+            clusters[-1] = (clusters[-1][0], end)
+        else:
+            clusters.append((start, end))
+    return clusters
 
-    X = good_indices.reshape(-1, 1)
-    gpr = GaussianProcessRegressor(kernel, n_restarts_optimizer=10, alpha=1e-10, normalize_y=True)
 
-    x_pred, x_std = gpr \
-        .fit(X, x[good_indices].reshape(-1, 1)) \
-        .predict(np.array(range(len(x))).reshape(-1, 1), return_std=True)
+def interpolate_nan_gpr_uncertainty(x, y, z, multi_output=False, kernels=None):
+    good_indices = np.nonzero(~np.isnan(x))[0]
+    all_indices = np.arange(len(x))
 
-    x = x_pred.T
+    if multi_output:
+        # one solve for all axes, so the uncertainty bands are consistent across x, y and z
+        xyz = np.column_stack([x[good_indices], y[good_indices], z[good_indices]])
+        xyz_pred, xyz_std = fit_predict_gpr(good_indices, xyz, all_indices, kernels, 'xyz', return_std=True)
+        x, y, z = xyz_pred.T
+        x_std, y_std, z_std = xyz_std.T
+        return x, y, z, x_std, y_std, z_std
 
-    y_pred, y_std = gpr \
-        .fit(X, y[good_indices].reshape(-1, 1)) \
-        .predict(np.array(range(len(x))).reshape(-1, 1), return_std=True)
+    x_pred, x_std = fit_predict_gpr(good_indices, x[good_indices], all_indices, kernels, 'x', return_std=True)
+    x = x_pred.T
 
+    y_pred, y_std = fit_predict_gpr(good_indices, y[good_indices], all_indices, kernels, 'y', return_std=True)
     y = y_pred.T
 
-    z_pred, z_std = gpr \
-        .fit(X, z[good_indices].reshape(-1, 1)) \
-        .predict(np.array(range(len(x))).reshape(-1, 1), return_std=True)
-
+    z_pred, z_std = fit_predict_gpr(good_indices, z[good_indices], all_indices, kernels, 'z', return_std=True)
     z = z_pred.T
 
     return x, y, z, x_std, y_std, z_std
+
+
+# Registry of imputers with a common batched interface: imputer(points, **kwargs) -> (filled, std)
+# points is a (3, n_markers, n_frames) array with NaN at the missing frames. std is the predictive standard deviation
+# at the imputed frames (NaN elsewhere) for methods that provide one, otherwise None.
+IMPUTERS = {}
+
+def register_imputer(name):
+    def decorator(imputer):
+        IMPUTERS[name] = imputer
+        return imputer
+    return decorator
+
+
+def impute(points, method, **kwargs):
+    if method not in IMPUTERS:
+        raise ValueError(f'Unknown imputation method {method!r}, registered methods: {sorted(IMPUTERS)}')
+    return IMPUTERS[method](points, **kwargs)
+
+
+def impute_per_marker(points, interpolate, per_marker_kwargs=None, return_std=False, **kwargs):
+    # Apply interpolate(x, y, z, **kwargs) to every marker that has gaps
+    # With return_std, interpolate(..., return_std=True) also returns the std of x, y and z, kept at the imputed frames
+    filled = np.array(points, dtype=float)
+    std = np.full(filled.shape, np.nan) if return_std else None
+    for m in GapIndex(filled).markers_with_gaps():
+        missing = np.isnan(filled[:, m])
+        if missing.all(): continue
+        marker_kwargs = per_marker_kwargs[m] if per_marker_kwargs else {}
+        if return_std: marker_kwargs = {**marker_kwargs, 'return_std': True}
+        x, y, z = filled[:, m].copy()
+        with profiling.stage('impute_marker', marker=profiling.marker_name(m), missing_frames=int(missing.sum())):
+            result = interpolate(x, y, z, **kwargs, **marker_kwargs)
+        filled[:, m] = result[:3]
+        if return_std: std[:, m][missing] = np.array(result[3:])[missing]
+    return filled, std
+
+
+@register_imputer('none')
+def impute_none(points):
+    return np.array(points, dtype=float), None
+
+
+@register_imputer('linear')
+def impute_linear(points):
+    filled, _ = interpolate_nan_linear_batch(points)
+    return filled, None
+
+
+@register_imputer('polynomial')
+def impute_polynomial(points, deg=80):
+    filled, _ = impute_per_marker(points, interpolate_nan_polynomial, deg=deg)
+    return filled, None
+
+
+@register_imputer('gpr')
+def impute_gpr(points, kernels=None, return_std=False, **kwargs):
+    # kwargs as for interpolate_nan_gpr, kernels holds one dict-like per marker
+    # the std costs an extra solve per gap, so it is only computed with return_std
+    per_marker_kwargs = [{'kernels': k} for k in kernels] if kernels is not None else None
+    return impute_per_marker(points, interpolate_nan_gpr, per_marker_kwargs, return_std, **kwargs)
+
+
+@register_imputer('kalman')
+def impute_kalman(points, return_std=True):
+    # the smoother computes the std anyway
+    return impute_per_marker(points, interpolate_nan_kalman, return_std=return_std)
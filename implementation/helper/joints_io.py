@@ -0,0 +1,61 @@
+import json
+from pathlib import Path
+import numpy as np
+
+# Reading and writing the 3D joint positions (joints_3d) of a trial
+#
+# json: {"<frame>": {"<marker>": [x, y, z], ...}, ...}
+# npy:  float32 (n_frames, n_markers, 3) array in <name>.npy, marker names and frame rate in <name>.meta.json.
+#       The .npy file is memory mapped when reading, so single frames are read without loading the whole trial.
+
+
+def write_joints_json(json_out_file, positions, marker_names, precision=None, indent=None):
+    """Write a (n_frames, n_markers, 3) array as {"<frame>": {"<marker>": [x, y, z], ...}, ...}, one frame at a time
+
+    - precision: number of decimals the positions are rounded to, full precision if not specified
+    - indent: as for json.dump, the most compact output if not specified
+    """
+    if precision is not None: positions = np.round(positions, precision)
+    encoder = json.JSONEncoder(indent=indent)
+    # the same separators and line breaks as json.dump(transformed_dict, file, indent=indent)
+    item_separator = ', ' if indent is None else ','
+    newline = '' if indent is None else '\n'
+    padding = '' if indent is None else ' ' * indent if isinstance(indent, int) else indent
+
+    with open(json_out_file, 'w') as file:
+        file.write('{')
+        for frame, frame_positions in enumerate(positions.tolist()):
+            markers = encoder.encode(dict(zip(marker_names, frame_positions))).replace('\n', '\n' + padding)
+            file.write(f'{item_separator if frame else ""}{newline}{padding}"{frame}": {markers}')
+        file.write(f'{newline if len(positions) else ""}}}')
+
+
+def meta_path(npy_path):
+    return Path(npy_path).with_suffix('.meta.json')
+
+
+def write_joints_npy(npy_path, positions, marker_names, fps):
+    positions = np.asarray(positions, dtype=np.float32)
+    assert positions.ndim == 3 and positions.shape[1:] == (len(marker_names), 3)
+    np.save(npy_path, positions)
+    meta = {'markers': list(marker_names), 'fps': fps, 'shape': list(positions.shape)}
+    with open(meta_path(npy_path), 'w') as file:
+        json.dump(meta, file, indent=4)
+
+
+def load_joints(npy_path):
+    """The memory mapped (n_frames, n_markers, 3) array and the metadata (markers, fps) of a trial"""
+    with open(meta_path(npy_path)) as file:
+        meta = json.load(file)
+    return np.load(npy_path, mmap_mode='r'), meta
+
+
+def read_frames(npy_path, start, stop=None):
+    """Positions of frame `start` (n_markers, 3), or of the frames start..stop-1 (n_frames, n_markers, 3)
+
+    Only the requested frames are read from disk.
+    """
+    positions = np.load(npy_path, mmap_mode='r')
+    if stop is None:
+        return np.array(positions[start])
+    return np.array(positions[start:stop])
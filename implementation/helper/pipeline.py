@@ -0,0 +1,87 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from .interpolate import decimate, impute
+from . import profiling
+
+# The preprocessing of the points of a trial as an ordered list of stages, e.g.
+#   [('smooth', {'sigma': 3}), ('impute', {'method': 'linear', 'markers': ['RASI', 'LASI']}), ('impute', {'method': 'gpr', 'use': 5})]
+# Every stage works on all markers of the (3, n_markers, n_frames) points at once, see STAGES for the registered stages.
+
+
+class PipelineData:
+    """The points passed from stage to stage, and what the stages record about them"""
+
+    def __init__(self, points, marker_names, kernels=None):
+        self.points = np.array(points, dtype=float)
+        self.marker_names = list(marker_names)
+        self.observed = ~np.isnan(self.points).any(axis=0) # frames based on captured data
+        self.std = np.full(self.points.shape, np.nan) # std of the imputation at the frames it predicted
+        self.kernels = kernels # marker name -> kernels dict-like of the GPR (see fit_predict_gpr), or None
+        self.imputed_markers = np.zeros(len(self.marker_names), dtype=bool) # markers an impute stage has handled
+
+
+STAGES = {}
+
+def register_stage(name):
+    def decorator(stage):
+        STAGES[name] = stage
+        return stage
+    return decorator
+
+
+def run_pipeline(points, marker_names, stages, kernels=None):
+    """Run the stages [(name, options), ...] in order, returns the processed points, the observed mask and the std"""
+    data = PipelineData(points, marker_names, kernels)
+    for name, options in stages:
+        if name not in STAGES:
+            raise ValueError(f'Unknown pipeline stage {name!r}, registered stages: {sorted(STAGES)}')
+        with profiling.stage(name, **options):
+            STAGES[name](data, **options)
+    return data.points, data.observed, data.std
+
+
+def nan_gaussian_filter1d(points, sigma, axis=-1):
+    """Gaussian smoothing along `axis` that ignores NaN (normalized convolution), NaN stays NaN
+
+    gaussian_filter1d spreads every NaN over the whole kernel (4 sigma to each side), here the frames next
+    to a gap are smoothed with the captured frames only, so the gaps do not grow.
+    """
+    missing = np.isnan(points)
+    weights = gaussian_filter1d((~missing).astype(float), sigma, axis=axis)
+    smoothed = gaussian_filter1d(np.where(missing, 0.0, points), sigma, axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        smoothed /= weights
+    smoothed[missing] = np.nan
+    return smoothed
+
+
+@register_stage('smooth')
+def smooth_stage(data: PipelineData, sigma=3, nan_aware=True):
+    # all markers and axes in one call. nan_aware=False smooths like gaussian_filter1d, which widens the gaps
+    if nan_aware:
+        data.points = nan_gaussian_filter1d(data.points, sigma)
+    else:
+        data.points = gaussian_filter1d(data.points, sigma, axis=-1)
+        data.observed &= ~np.isnan(data.points).any(axis=0)
+
+
+@register_stage('impute')
+def impute_stage(data: PipelineData, method, markers=None, use=1, **kwargs):
+    # impute the markers named in `markers`, or all markers that no earlier impute stage has handled,
+    # with a registered imputer (see helper.interpolate.IMPUTERS). use decimates the frames as in interpolate_missing
+    if markers is None:
+        selected = np.nonzero(~data.imputed_markers)[0]
+    else:
+        selected = np.array([i for i, name in enumerate(data.marker_names) if name in markers], dtype=int)
+    data.imputed_markers[selected] = True
+    if len(selected) == 0: return
+
+    points, _, _ = decimate(data.points[:, selected], 1, use)
+    if method == 'gpr' and data.kernels is not None:
+        kwargs['kernels'] = [data.kernels(data.marker_names[i]) for i in selected]
+    if method in ('gpr', 'kalman'):
+        kwargs['return_std'] = True
+    with profiling.marker_names([data.marker_names[i] for i in selected]):
+        filled, std = impute(points, method, **kwargs)
+    data.points[:, selected] = filled
+    if std is not None: data.std[:, selected] = std
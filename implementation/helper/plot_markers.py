@@ -1,5 +1,7 @@
-from helper.util import group_intervals
+from .util import group_intervals
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection, PolyCollection
 
 # helper for 2D and 3D plotting of c3d data
 
@@ -22,19 +24,110 @@ def plot_3d(self, x, y, z):
 
 
 def plot_2d(ax, title, x, y, z, missing_indices=[], corrupt_indices=[]):
-    # Plot the points
-    framecount = len(x)
-    ax.plot(range(framecount), x, linewidth=2.0, label='x', color='tab:blue')
-    ax.plot(range(framecount), y, linewidth=2.0, label='y', color='tab:orange')
-    ax.plot(range(framecount), z, linewidth=2.0, label='z', color='tab:green')
+    # Plot the points, decimated to the width of the axes (see DecimatedLines), with all gaps in one collection
+    lines = DecimatedLines(ax, [x, y, z], labels=['x', 'y', 'z'], colors=['tab:blue', 'tab:orange', 'tab:green'], linewidth=2.0)
 
-    for p in group_intervals(missing_indices):
-        ax.axvspan(p[0], p[1], color='#ff8080', alpha=0.2)
-    for p in group_intervals(corrupt_indices):
-        ax.axvspan(p[0], p[1], color='#ffed42', alpha=0.2)
+    add_spans(ax, group_intervals(missing_indices), color='#ff8080', alpha=0.2)
+    add_spans(ax, group_intervals(corrupt_indices), color='#ffed42', alpha=0.2)
 
     # Label the axes
     ax.set_xlabel('Frames')
     ax.set_ylabel('Deflection in mm')
 
     ax.set_title(title)
+    return lines
+
+
+def add_spans(ax, intervals, **kwargs):
+    # like calling ax.axvspan(start, end) for every interval, but as a single artist
+    if len(intervals) == 0: return None
+    rectangles = [[(start, 0), (start, 1), (end, 1), (end, 0)] for start, end in intervals]
+    spans = PolyCollection(rectangles, transform=ax.get_xaxis_transform(), linewidth=0, **kwargs)
+    ax.add_collection(spans, autolim=False)
+    return spans
+
+
+def minmax_decimate(values, start, stop, n_bins):
+    """Frames and values of values[start:stop], reduced to the minimum and maximum of each of n_bins bins
+
+    The line through these points looks the same as the full line at a width of n_bins pixels.
+    Bins with missing values end with a NaN, so the line shows the gap.
+    """
+    values = values[start:stop]
+    bin_size = int(np.ceil(len(values) / n_bins))
+    if bin_size <= 2:
+        return np.arange(start, start + len(values)), values
+
+    n_bins = int(np.ceil(len(values) / bin_size))
+    bins = np.full(n_bins * bin_size, np.nan)
+    bins[:len(values)] = values
+    bins = bins.reshape(n_bins, bin_size)
+    missing = np.isnan(bins)
+    empty = missing.all(axis=1)
+
+    low = np.argmin(np.where(missing, np.inf, bins), axis=1)
+    high = np.argmax(np.where(missing, -np.inf, bins), axis=1)
+    first, second = np.minimum(low, high), np.maximum(low, high) # in frame order
+    rows = np.arange(n_bins)
+    offsets = start + rows * bin_size
+
+    frames = np.column_stack([offsets + first, offsets + second, offsets + bin_size - 1]).astype(float)
+    points = np.column_stack([bins[rows, first], bins[rows, second], np.full(n_bins, np.nan)])
+    points[empty, :2] = np.nan
+    keep = np.ones(frames.shape, dtype=bool)
+    keep[:, 2] = missing.any(axis=1) # the NaN break only where the bin has a gap
+    return frames[keep], points[keep]
+
+
+class DecimatedLines:
+    """One LineCollection per curve, redrawn with min/max decimation whenever the x limits change
+
+    Only about two points per pixel column are drawn, however long the trial, so panning and zooming stays fast.
+    """
+
+    def __init__(self, ax, curves, labels, colors, **kwargs):
+        self.ax = ax
+        self.curves = [np.asarray(c, dtype=float) for c in curves]
+        self.collections = []
+        for label, color in zip(labels, colors):
+            collection = LineCollection([], label=label, color=color, **kwargs)
+            ax.add_collection(collection, autolim=False)
+            self.collections.append(collection)
+
+        # data limits of the full curves, as ax.plot would set them
+        n_frames = max(len(c) for c in self.curves)
+        finite = [c[np.isfinite(c)] for c in self.curves]
+        finite = np.concatenate(finite) if any(len(f) for f in finite) else np.zeros(1)
+        ax.update_datalim([(0, finite.min()), (n_frames - 1, finite.max())])
+        ax.autoscale_view()
+
+        self.update(ax)
+        # the registry only keeps a weak reference to a bound method, which would be gone with the discarded return
+        # value of plot_2d. The closure is kept by the axes, and so is this object.
+        ax.callbacks.connect('xlim_changed', lambda ax: self.update(ax))
+
+    def update(self, ax):
+        x0, x1 = ax.get_xlim()
+        n_bins = max(int(ax.get_window_extent().width), 1)
+        for curve, collection in zip(self.curves, self.collections):
+            start = max(int(np.floor(x0)) - 1, 0)
+            stop = min(int(np.ceil(x1)) + 2, len(curve))
+            frames, values = minmax_decimate(curve, start, max(stop, start), n_bins)
+            collection.set_segments([np.column_stack([frames, values])])
+
+
+def show_or_save(fig, out_path=None, close=True):
+    # show the figure in a blocking window, or save it to out_path (e.g. .png or .pdf) without a window
+    if out_path is None:
+        plt.show(block=True)
+        return
+    fig.savefig(out_path)
+    if close: plt.close(fig)
+
+
+def marker_grid(figsize=(20, 16)):
+    # one subplot per marker, 8 x 5 for the 39 markers of the PlugInGait set
+    fig, axis = plt.subplots(8, 5, figsize=figsize)
+    axis[7, 4].axis('off') # no 40th marker
+    fig.subplots_adjust(left=0.04, right=0.99, bottom=0.04, top=0.97, hspace=0.6, wspace=0.25)
+    return fig, axis
@@ -0,0 +1,161 @@
+import cProfile
+import json
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Per-stage timing of the preprocessing scripts (fix_c3d_folder.py, handle_S3_jumpingjacks.py, osim_to_json.py)
+#
+# The scripts wrap their stages in `with stage('parse'):`. While profiling is enabled, every stage appends one line
+# to a JSON lines log with its wall time, CPU time and the peak RSS of the process, the fields passed to stage() and
+# those of the enclosing context() blocks (e.g. the file). Stages nest, e.g. the imputation of one marker inside the
+# impute stage, and count() adds to the counters of all open stages, e.g. the iterations of the hyperparameter optimizer.
+# Profiling is off unless enable() is called. The settings are environment variables, so the worker processes
+# started afterwards log to the same file. preprocessing/profile_summary.py summarizes a log.
+#
+# py-spy needs no hook: `py-spy record --subprocesses -o trace.json --format speedscope -- python fix_c3d_folder.py ...`
+# samples all workers, and the pid and start time of every record match its samples to the stage.
+
+LOG_VARIABLE = 'MPC_PROFILE_LOG' # path of the JSON lines log
+CPROFILE_VARIABLE = 'MPC_CPROFILE_DIR' # if set, the outermost stages also run under cProfile and are dumped to this folder
+
+_open = [] # records of the open stages, innermost last
+_context = {}
+_marker_names = None
+_n_dumps = 0
+
+
+def enable(log_path, cprofile_dir=None):
+    """Log the stages of this process, and of the worker processes it starts from now on, to log_path"""
+    Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+    os.environ[LOG_VARIABLE] = str(Path(log_path).resolve())
+    if cprofile_dir:
+        Path(cprofile_dir).mkdir(parents=True, exist_ok=True)
+        os.environ[CPROFILE_VARIABLE] = str(Path(cprofile_dir).resolve())
+
+
+def enabled():
+    return bool(os.environ.get(LOG_VARIABLE))
+
+
+@contextmanager
+def context(**fields):
+    # fields added to the records of all stages inside the block, e.g. file=... or chunk=...
+    global _context
+    outer = _context
+    _context = {**outer, **fields}
+    try:
+        yield
+    finally:
+        _context = outer
+
+
+@contextmanager
+def marker_names(names):
+    # names of the markers the imputers inside the block see by index, see marker_name
+    global _marker_names
+    outer, _marker_names = _marker_names, list(names)
+    try:
+        yield
+    finally:
+        _marker_names = outer
+
+
+def marker_name(index):
+    return _marker_names[index] if _marker_names is not None else int(index)
+
+
+def count(**increments):
+    # add to the counters of all open stages, e.g. count(optimizer_iterations=12)
+    for record in _open:
+        for key, value in increments.items():
+            record[key] = record.get(key, 0) + value
+
+
+@contextmanager
+def stage(name, **fields):
+    """Log the wall time, CPU time and peak RSS of the block as stage `name`, does nothing while profiling is disabled
+
+    Yields the record, fields added to it are logged as well. CPU time includes all threads of the process (BLAS).
+    peak_rss_mb is the high-water mark of the process so far, rss_growth_mb how much the stage raised it.
+    """
+    log_path = os.environ.get(LOG_VARIABLE)
+    if not log_path:
+        yield {}
+        return
+
+    record = {'stage': name, **_context, **fields}
+    cprofile_dir = os.environ.get(CPROFILE_VARIABLE)
+    profiler = cProfile.Profile() if cprofile_dir and not _open else None # only one profiler can run at a time
+    _open.append(record)
+    peak_before = peak_rss_mb()
+    start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    if profiler is not None: profiler.enable()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        if profiler is not None: profiler.disable()
+        record['wall_s'] = round(time.perf_counter() - wall, 6)
+        record['cpu_s'] = round(time.process_time() - cpu, 6)
+        _open.pop()
+        peak = peak_rss_mb()
+        record.update({'peak_rss_mb': peak, 'rss_growth_mb': round(peak - peak_before, 1) if peak is not None else None,
+                       'depth': len(_open), 'pid': os.getpid(), 'start': round(start, 3)})
+        if profiler is not None: record['cprofile'] = dump_cprofile(profiler, record, cprofile_dir)
+        write_record(log_path, record)
+
+
+def write_record(log_path, record):
+    # one write per line in append mode, so the lines of concurrent worker processes do not interleave
+    line = json.dumps(record, default=lambda value: value.item() if hasattr(value, 'item') else str(value)) + '\n'
+    with open(log_path, 'a') as file:
+        file.write(line)
+
+
+def dump_cprofile(profiler, record, cprofile_dir):
+    # e.g. S3_drinking_normal.c3d_file_1234_0.prof, open it with `python -m pstats` or snakeviz
+    global _n_dumps
+    label = re.sub(r'[^\w.-]', '_', f"{record.get('file', 'run')}_{record['stage']}")
+    path = Path(cprofile_dir, f'{label}_{os.getpid()}_{_n_dumps}.prof')
+    _n_dumps += 1
+    profiler.dump_stats(path)
+    return str(path)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, None if the platform does not report it"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / 2**20 if sys.platform == 'darwin' else peak / 2**10, 1) # bytes on macOS, KB on Linux
+    if sys.platform == 'win32':
+        return round(_windows_peak_working_set() / 2**20, 1)
+    return None
+
+
+def _windows_peak_working_set():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                   [(name, ctypes.c_size_t) for name in ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                                                        'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+    get_current_process.restype = wintypes.HANDLE
+    get_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+    get_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    get_memory_info(get_current_process(), ctypes.byref(counters), counters.cb)
+    return counters.PeakWorkingSetSize
@@ -0,0 +1,132 @@
+import math
+import numpy as np
+from scipy.optimize import minimize
+from . import profiling
+
+# Gaussian process regression with a Matern-3/2 kernel in state-space form.
+# The kernel sigma^2 * Matern(l, nu=1.5) has an exact representation as a linear stochastic differential
+# equation, so the GP posterior at regularly sampled frames is given by a Kalman filter followed by a
+# Rauch-Tung-Striebel smoother. That costs O(n) instead of the O(n^3) of the dense GP.
+# State: (position, velocity) per output; all outputs share the hyperparameters and the covariances.
+
+def matern32_model(variance, lengthscale):
+    # transition matrix and process noise for one frame, stationary covariance
+    lam = math.sqrt(3) / lengthscale
+    A = math.exp(-lam) * np.array([[1 + lam, 1], [-lam**2, 1 - lam]])
+    P_inf = np.diag([variance, lam**2 * variance])
+    Q = P_inf - A @ P_inf @ A.T
+    return A, Q, P_inf
+
+
+def kalman_filter(Y, observed, variance, lengthscale, noise=1e-10, keep=False):
+    """Filter the (n, k) targets Y (frames that are not `observed` are skipped).
+
+    Returns the log marginal likelihood, and with `keep` also the predicted and filtered means and covariances.
+    Plain floats are used for the 2x2 covariance, which is much faster than numpy for matrices this small.
+    """
+    A, Q, P_inf = matern32_model(variance, lengthscale)
+    a00, a01, a10, a11 = A.ravel()
+    q00, q01, q11 = Q[0, 0], Q[0, 1], Q[1, 1]
+    n, k = Y.shape
+    rows = Y.tolist()
+
+    pos = [0.0] * k
+    vel = [0.0] * k
+    p00, p01, p11 = P_inf[0, 0], 0.0, P_inf[1, 1]
+    log_likelihood = 0.0
+    if keep:
+        m_pred = np.empty((n, 2, k))
+        m_filt = np.empty((n, 2, k))
+        P_pred = np.empty((n, 3))
+        P_filt = np.empty((n, 3))
+
+    for t in range(n):
+        if t > 0:
+            # predict: m = A m, P = A P A^T + Q
+            pos, vel = [a00 * p + a01 * v for p, v in zip(pos, vel)], [a10 * p + a11 * v for p, v in zip(pos, vel)]
+            b00 = a00 * p00 + a01 * p01
+            b01 = a00 * p01 + a01 * p11
+            b10 = a10 * p00 + a11 * p01
+            b11 = a10 * p01 + a11 * p11
+            p00, p01, p11 = b00 * a00 + b01 * a01 + q00, b00 * a10 + b01 * a11 + q01, b10 * a10 + b11 * a11 + q11
+        if keep:
+            m_pred[t, 0], m_pred[t, 1] = pos, vel
+            P_pred[t] = p00, p01, p11
+
+        if observed[t]:
+            # update with the observed position (H = [1, 0])
+            s = p00 + noise
+            k0, k1 = p00 / s, p01 / s
+            residuals = [y - p for y, p in zip(rows[t], pos)]
+            pos = [p + k0 * r for p, r in zip(pos, residuals)]
+            vel = [v + k1 * r for v, r in zip(vel, residuals)]
+            p00, p01, p11 = p00 - k0 * p00, p01 - k0 * p01, p11 - k1 * p01
+            log_likelihood -= 0.5 * (k * math.log(2 * math.pi * s) + sum(r * r for r in residuals) / s)
+        if keep:
+            m_filt[t, 0], m_filt[t, 1] = pos, vel
+            P_filt[t] = p00, p01, p11
+
+    if keep:
+        return log_likelihood, (A, m_pred, m_filt, P_pred, P_filt)
+    return log_likelihood
+
+
+def rts_smoother(A, m_pred, m_filt, P_pred, P_filt):
+    # Rauch-Tung-Striebel smoother, returns the posterior mean (n, k) and variance (n,) of the position
+    n = len(m_filt)
+    mean = np.empty((n, m_filt.shape[2]))
+    var = np.empty(n)
+    m_s = m_filt[-1]
+    s00, s01, s11 = P_filt[-1]
+    mean[-1], var[-1] = m_s[0], s00
+    for t in range(n - 2, -1, -1):
+        f00, f01, f11 = P_filt[t]
+        r00, r01, r11 = P_pred[t + 1]
+        det = r00 * r11 - r01 * r01
+        # G = P_filt A^T P_pred^-1
+        c00 = f00 * A[0, 0] + f01 * A[0, 1]
+        c01 = f00 * A[1, 0] + f01 * A[1, 1]
+        c10 = f01 * A[0, 0] + f11 * A[0, 1]
+        c11 = f01 * A[1, 0] + f11 * A[1, 1]
+        g00, g01 = (c00 * r11 - c01 * r01) / det, (c01 * r00 - c00 * r01) / det
+        g10, g11 = (c10 * r11 - c11 * r01) / det, (c11 * r00 - c10 * r01) / det
+        G = np.array([[g00, g01], [g10, g11]])
+
+        m_s = m_filt[t] + G @ (m_s - m_pred[t + 1])
+        d = np.array([[s00 - r00, s01 - r01], [s01 - r01, s11 - r11]])
+        P_s = np.array([[f00, f01], [f01, f11]]) + G @ d @ G.T
+        s00, s01, s11 = P_s[0, 0], P_s[0, 1], P_s[1, 1]
+        mean[t], var[t] = m_s[0], s00
+    return mean, var
+
+
+def fit_matern32(Y, observed, bounds=(1e-3, 1e3), starts=((1.0, 10.0), (1.0, 100.0))):
+    """Maximum likelihood variance and lengthscale (in frames) for normalized targets, as the GPR optimizer does"""
+    log_bounds = [(math.log(bounds[0]), math.log(bounds[1]))] * 2
+    objective = lambda theta: -kalman_filter(Y, observed, math.exp(theta[0]), math.exp(theta[1]))
+    best = None
+    for start in starts:
+        result = minimize(objective, np.log(start), method='L-BFGS-B', bounds=log_bounds)
+        profiling.count(optimizer_runs=1, optimizer_iterations=result.nit, optimizer_evaluations=result.nfev)
+        if best is None or result.fun < best.fun:
+            best = result
+    return math.exp(best.x[0]), math.exp(best.x[1])
+
+
+def smooth_matern32(Y, observed, variance=None, lengthscale=None):
+    """Posterior mean (n, k) and std (n, k) at every frame, for the (n, k) targets Y with NaN at unobserved frames.
+
+    Targets are normalized per output like GaussianProcessRegressor(normalize_y=True).
+    Without variance and lengthscale, they are fitted first.
+    """
+    y_mean = np.nanmean(Y[observed], axis=0)
+    y_std = np.nanstd(Y[observed], axis=0)
+    y_std[y_std == 0] = 1.0
+    Y_norm = np.where(observed[:, np.newaxis], (Y - y_mean) / y_std, 0.0)
+
+    if variance is None or lengthscale is None:
+        variance, lengthscale = fit_matern32(Y_norm, observed)
+    _, filtered = kalman_filter(Y_norm, observed, variance, lengthscale, keep=True)
+    mean, var = rts_smoother(*filtered)
+    std = np.sqrt(np.maximum(var, 0))[:, np.newaxis]
+    return mean * y_std + y_mean, std * y_std
@@ -1,38 +1,165 @@
+from collections import OrderedDict
+from functools import cached_property
+from os import stat
+from pathlib import Path
 from ezc3d import c3d
 import numpy as np
 
 # Some common utility methods
 
-def get_marker_names(c3d_file_path):
-    return c3d(c3d_file_path)['parameters']['POINT']['LABELS']['value'][0:39]
+NUM_MARKERS = 39 # markers of the PlugInGait set, the remaining labels are unlabeled points
+SKIPPED_TRIALS = {('s3', 'jumpingjacks', 'normal')} # poor quality captures, (subject, action, variation) as in parse_trial_name
 
 
-def get_keypoints(c3d_file_path, keypoint_idx):
-    # get relevant keypoints
-    c = c3d(c3d_file_path)
-    point_data = c['data']['points']
-    point_data_relevant = np.squeeze(point_data[:3, keypoint_idx, :])
-    frames = np.swapaxes(point_data_relevant, 0, 1)
+class Trial:
+    """A c3d file that is parsed once. points, labels and rate are views into the parsed file."""
 
-    # extract x, y, and z coordinates
-    x = frames[:, 0]
-    y = frames[:, 1]
-    z = frames[:, 2]
+    def __init__(self, c3d_file_path):
+        self.path = str(c3d_file_path)
+        self.c3d = c3d(self.path)
 
-    return x, y, z
+    @property
+    def points(self):
+        # (3, n_markers, n_frames), without the homogeneous coordinate
+        return self.c3d['data']['points'][:3]
+
+    @property
+    def labels(self):
+        return self.c3d['parameters']['POINT']['LABELS']['value']
+
+    @property
+    def marker_names(self):
+        return self.labels[0:NUM_MARKERS]
+
+    @property
+    def rate(self):
+        return float(self.c3d['parameters']['POINT']['RATE']['value'][0])
+
+    @property
+    def frame_count(self):
+        return self.points.shape[2]
+
+    @cached_property
+    def gaps(self):
+        # gaps of the labelled markers, computed on first use
+        return GapIndex(self.points[:, :NUM_MARKERS, :])
+
+    def keypoints(self, keypoint_idx):
+        # copies, so callers may modify x, y and z without touching the trial
+        x, y, z = self.points[:, keypoint_idx, :].copy()
+        return x, y, z
+
+
+class C3DCache:
+    """Keeps the last `maxsize` parsed trials. Entries are invalidated when the file changes on disk."""
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self._trials = OrderedDict()
+
+    def get(self, c3d_file_path):
+        path = str(c3d_file_path)
+        st = stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        if key in self._trials:
+            self._trials.move_to_end(key)
+            return self._trials[key]
+        trial = Trial(path)
+        self._trials[key] = trial
+        while len(self._trials) > self.maxsize:
+            self._trials.popitem(last=False)
+        return trial
+
+    def clear(self):
+        self._trials.clear()
+
+
+_cache = C3DCache()
+
+def load_trial(trial_or_path):
+    # accept an already loaded trial or a path (parsed at most once while it stays in the cache)
+    if isinstance(trial_or_path, Trial):
+        return trial_or_path
+    return _cache.get(trial_or_path)
+
+
+def get_marker_names(trial):
+    return load_trial(trial).marker_names
+
+
+def get_keypoints(trial, keypoint_idx):
+    # get relevant keypoints, x, y and z coordinates
+    return load_trial(trial).keypoints(keypoint_idx)
+
+
+def parse_trial_name(c3d_file_path):
+    # 's1_drinking_normal.c3d' -> ('s1', 'drinking', 'normal'), ValueError for other names
+    parts = Path(c3d_file_path).stem.lower().split('_')
+    if len(parts) < 3:
+        raise ValueError(f'{Path(c3d_file_path).name} is not named <subject>_<action>_<variation>')
+    subject, action, variation = parts[:3]
+    return subject, action, variation
 
 
 def group_intervals(data):
+    # runs of consecutive indices as inclusive (start, end) pairs, e.g. [1, 2, 3, 7] -> [(1, 3), (7, 7)]
+    data = np.asarray(data)
     if len(data) == 0: return []
-    intervals = []
-    start = data[0]
-    end = data[0]
-    for num in data[1:]:
-        if num == end + 1:
-            end = num
-        else:
-            intervals.append((start, end))
-            start = num
-            end = num
-    intervals.append((start, end))
-    return intervals
\ No newline at end of file
+    breaks = np.nonzero(np.diff(data) != 1)[0]
+    starts = data[np.r_[0, breaks + 1]]
+    ends = data[np.r_[breaks, len(data) - 1]]
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+GAP_DTYPE = np.dtype([('axis', int), ('marker', int), ('start', int), ('end', int), ('length', int)])
+
+def gap_table(missing):
+    """All gaps of a (3, n_markers, n_frames) NaN mask as one structured array (start and end are inclusive)"""
+    n_axes, n_markers, n_frames = missing.shape
+    rows = missing.reshape(-1, n_frames)
+    padded = np.zeros((rows.shape[0], n_frames + 2), dtype=np.int8)
+    padded[:, 1:-1] = rows
+    edges = np.diff(padded, axis=1)
+    # nonzero is row-major, so the n-th start and the n-th end belong to the same gap
+    start_row, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+
+    gaps = np.empty(len(starts), dtype=GAP_DTYPE)
+    gaps['axis'], gaps['marker'] = np.divmod(start_row, n_markers)
+    gaps['start'] = starts
+    gaps['end'] = ends - 1
+    gaps['length'] = ends - starts
+    return gaps
+
+
+class GapIndex:
+    """The gaps of a (3, n_markers, n_frames) point array, found in one vectorized pass over its NaN mask
+
+    gaps is the structured array of gap_table: axis, marker, start, end (inclusive) and length of every gap.
+    """
+
+    def __init__(self, points):
+        self.shape = np.shape(points)
+        self.gaps = gap_table(np.isnan(points))
+
+    def __len__(self):
+        return len(self.gaps)
+
+    def longer_than(self, n_frames):
+        return self.gaps[self.gaps['length'] > n_frames]
+
+    def of_marker(self, marker, axis=None):
+        selected = self.gaps['marker'] == marker
+        if axis is not None: selected &= self.gaps['axis'] == axis
+        return self.gaps[selected]
+
+    def markers_with_gaps(self):
+        return np.unique(self.gaps['marker'])
+
+    def markers_without_gaps(self):
+        return np.setdiff1d(np.arange(self.shape[1]), self.gaps['marker'])
+
+    def intervals(self, marker, axis=0):
+        # (start, end) pairs like group_intervals, e.g. for the span overlays of the plots
+        gaps = self.of_marker(marker, axis)
+        return list(zip(gaps['start'].tolist(), gaps['end'].tolist()))
@@ -4,9 +4,9 @@ sys.path.append("..//implementation")
 import math
 import numpy as np
 import matplotlib.pyplot as plt
-from helper.plot_markers import plot_2d
-from helper.util import group_intervals, get_keypoints, get_marker_names
-from helper.interpolate import interpolate_missing, interpolate_nan_gpr_uncertainty
+from helper.plot_markers import plot_2d, show_or_save
+from helper.util import Trial, get_keypoints, load_trial
+from helper.interpolate import decimate, interpolate_missing, interpolate_nan_gpr_uncertainty
 from scipy.ndimage import gaussian_filter1d
 
 # Contains methods for plotting c3d files in different ways
@@ -18,7 +18,8 @@ def main():
     use = 1   # How many indices will be set to NaN
 
     # Get marker names and find the index for LASI
-    marker_names = get_marker_names(c3d_file_path)
+    trial = Trial(c3d_file_path) # parse once, all plots take their markers from it
+    marker_names = trial.marker_names
     try:
         lasi_index = marker_names.index("C7")  # Locate LASI marker
     except ValueError:
@@ -33,20 +34,20 @@ def main():
         print(f"Generating plot for diagram type: {diagram}")
         match diagram:
             case 'raw':
-                plot_raw(c3d_file_path, marker_names, lasi_index, method, take, use)
+                plot_raw(trial, marker_names, lasi_index, method, take, use)
             case 'single':
-                plot_single(c3d_file_path, marker_names, lasi_index, method, take, use)
+                plot_single(trial, marker_names, lasi_index, method, take, use)
             case 'compare':
-                plot_compare(c3d_file_path, marker_names, lasi_index, take, use)
+                plot_compare(trial, marker_names, lasi_index, take, use)
             case 'uncertainty':
-                plot_uncertainty(c3d_file_path, marker_names, lasi_index, take, use)
+                plot_uncertainty(trial, marker_names, lasi_index, take, use)
             case 'smoothing':
-                plot_smoothing(c3d_file_path, marker_names, lasi_index)
+                plot_smoothing(trial, marker_names, lasi_index)
 
-def plot_raw(c3d_file_path, marker_names, keypoint_idx, method, take, use):
+def plot_raw(trial, marker_names, keypoint_idx, method, take, use, out_path=None):
     """Plot the raw LASI marker data using plot_2d."""
     title = f'{marker_names[keypoint_idx]} ({keypoint_idx})'
-    x, y, z = get_keypoints(c3d_file_path, keypoint_idx)
+    x, y, z = get_keypoints(trial, keypoint_idx)
     #x, y, z = x[600:900], y[600:900], z[600:900]
 
     # Use plot_2d to visualize the raw data
@@ -56,44 +57,48 @@ def plot_raw(c3d_file_path, marker_names, keypoint_idx, method, take, use):
 
     # Show the plot
     plt.legend(loc='upper right', fontsize=12)
-    plt.show()
+    show_or_save(plt.gcf(), out_path)
 
-def plot_single(c3d_file_path, marker_names, keypoint_idx, method='linear', take=1, use=1):
+def plot_single(trial, marker_names, keypoint_idx, method='linear', take=1, use=1, out_path=None):
     title = f'{marker_names[keypoint_idx]} ({keypoint_idx})'
-    x, y, z = get_keypoints(c3d_file_path, keypoint_idx)
+    x, y, z = get_keypoints(trial, keypoint_idx)
     ax2 = plt.axes()
     x, y, z, missing_indices = interpolate_missing(x, y, z, method, take, use)
     plot_2d(ax2, title, x, y, z, missing_indices, [])
 
     plt.legend(loc='upper right', fontsize=12)
-    plt.show(block=True)
+    show_or_save(plt.gcf(), out_path)
 
 
-def plot_multi(c3d_file_path, marker_names, method='linear'):
-    _, axis = plt.subplots(8, 5)
+def plot_multi(trial, marker_names, method='linear', out_path=None, axis=None):
+    # axis: the 8 x 5 axes of an existing figure to draw into (they are cleared), instead of a new figure
+    reuse = axis is not None
+    if reuse:
+        for ax in axis.flat[:39]: ax.cla()
+    else:
+        _, axis = plt.subplots(8, 5)
     for i in range(39):
         ax = axis[math.floor(i/5), i % 5]
-        x, y, z = get_keypoints(c3d_file_path, i)
+        x, y, z = get_keypoints(trial, i)
         x, y, z, missing_indices = interpolate_missing(x, y, z, method)
         title = f'{marker_names[i]} ({i})'
         plot_2d(ax, title, x, y, z, missing_indices, [])
-    plt.legend(loc='lower right')
-    plt.show(block=True)
+    ax.legend(loc='lower right')
+    show_or_save(ax.figure, out_path, close=not reuse)
 
 
-def plot_compare(c3d_file_path, marker_names, keypoint_idx, take=1, use=1):
+def plot_compare(trial, marker_names, keypoint_idx, take=1, use=1, out_path=None):
     ax = plt.axes()
-    x, y, z = get_keypoints(c3d_file_path, keypoint_idx)
+    x, y, z = get_keypoints(trial, keypoint_idx)
     #x, y, z = x[600:900], y[600:900], z[600:900]
     length = len(x)
-    missing_indices = np.where(np.isnan(x))[0]
 
-    for p in group_intervals(missing_indices):
+    for p in load_trial(trial).gaps.intervals(keypoint_idx):
         ax.axvspan(p[0], p[1], color='#ff8080', alpha=0.2)
     ax.plot(range(length), y, linewidth=2, label='y captured', alpha=1, color='tab:orange', zorder=10)
 
     method = 'linear'
-    x, y, z = get_keypoints(c3d_file_path, keypoint_idx)
+    x, y, z = get_keypoints(trial, keypoint_idx)
     x, y, z, _ = interpolate_missing(x, y, z, method, take, use)
     #x, y, z = x[600:900], y[600:900], z[600:900]
     # ax.plot(range(length), x, linewidth=2.0, label='x linear interp.')
@@ -101,7 +106,7 @@ def plot_compare(c3d_file_path, marker_names, keypoint_idx, take=1, use=1):
     # ax.plot(range(length), z, linewidth=2.0, label='z linear interp.')
 
     method = 'gpr'
-    x, y, z = get_keypoints(c3d_file_path, keypoint_idx)
+    x, y, z = get_keypoints(trial, keypoint_idx)
     x, y, z, _ = interpolate_missing(x, y, z, method, take, use)
     # ax.plot(range(length), x, linewidth=2, label='x gpr interp.')
     ax.plot(range(length), y, linewidth=2, label='y gpr interp.', color='tab:pink', alpha=1)
@@ -112,28 +117,22 @@ def plot_compare(c3d_file_path, marker_names, keypoint_idx, take=1, use=1):
     ax.set_ylabel('Y [mm]')
 
     plt.legend(loc='upper right')
-    plt.show(block=True)
+    show_or_save(plt.gcf(), out_path)
 
 
-def plot_uncertainty(c3d_file_path, marker_names, keypoint_idx, take, use):
+def plot_uncertainty(trial, marker_names, keypoint_idx, take, use, out_path=None):
     ax = plt.axes()
 
-    x, y, z = get_keypoints(c3d_file_path, keypoint_idx)
+    x, y, z = get_keypoints(trial, keypoint_idx)
     length = len(x)
-    missing_indices = np.where(np.isnan(x))[0]
     # for p in range(0, length, use):
     #     ax.axvspan(p, p+1, color='#a0a0a0', alpha=0.1)
-    for p in group_intervals(missing_indices):
+    for p in load_trial(trial).gaps.intervals(keypoint_idx):
         ax.axvspan(p[0], p[1], color='#ff8080', alpha=0.2)
 
     ax.plot(range(length), y, linewidth=2, label='y captured', alpha=1, color='tab:orange', zorder=10)
 
-    x, y, z = get_keypoints(c3d_file_path, keypoint_idx)
-
-    missing_indices = np.where(np.isnan(x))[0]
-    x = np.array([elem if i % use == 0 else np.nan for (i, elem) in enumerate(x)])[::take]
-    y = np.array([elem if i % use == 0 else np.nan for (i, elem) in enumerate(y)])[::take]
-    z = np.array([elem if i % use == 0 else np.nan for (i, elem) in enumerate(z)])[::take]
+    (x, y, z), _, _ = decimate(np.array(get_keypoints(trial, keypoint_idx)), take, use)
 
     x, y, z, x_std, y_std, z_std = interpolate_nan_gpr_uncertainty(x, y, z)
 
@@ -174,13 +173,13 @@ def plot_uncertainty(c3d_file_path, marker_names, keypoint_idx, take, use):
     ax.set_ylabel('X, Y, Z in mm')
 
     plt.legend(loc='upper right')
-    plt.show(block=True)
+    show_or_save(plt.gcf(), out_path)
 
 
-def plot_smoothing(c3d_file_path, marker_names, keypoint_idx):
+def plot_smoothing(trial, marker_names, keypoint_idx, out_path=None):
     ax = plt.axes()
     title = f'{marker_names[keypoint_idx]} ({keypoint_idx})'
-    x, y, z = get_keypoints(c3d_file_path, keypoint_idx)
+    x, y, z = get_keypoints(trial, keypoint_idx)
 
     length = len(x)
     ax.plot(range(length), y, linewidth=2, label='y captured', alpha=0.5, color='tab:orange')
@@ -198,7 +197,7 @@ def plot_smoothing(c3d_file_path, marker_names, keypoint_idx):
     title = f'{marker_names[keypoint_idx]} ({keypoint_idx})'
     ax.set_title(title)
     plt.legend(loc='upper right')
-    plt.show(block=True)
+    show_or_save(plt.gcf(), out_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,160 @@
+import sys
+sys.path.append("..//implementation")
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import numpy as np
+from scipy.ndimage import median_filter
+from tqdm import tqdm
+
+from helper.util import Trial, group_intervals
+from helper.interpolate import interpolate_nan_linear_batch
+from helper.batch import collect_c3d_files, record_error
+
+# Screen c3d files for corrupt segments (markers jumping to wrong positions, as in the S3 jumpingjacks captures)
+# Every marker is scored per frame with rolling robust z-scores (median / MAD over WINDOW frames) of
+#   - the deviation of its position from the rolling median position
+#   - its speed and acceleration
+#   - the distances to the other markers of the same rigid segment (these should hardly change)
+# A frame is corrupt if MIN_MARKERS markers are outliers, or a rigid segment is violated.
+# The corrupt frames are written as (start, end) ranges, in the format of handle_S3_jumpingjacks.AFFECTED_FILES.
+
+WINDOW = 101 # frames of the rolling median, longer than the corrupt segments we want to find
+Z_THRESHOLD = 8
+MIN_MARKERS = 3 # markers that have to be outliers in the same frame
+PAD = 2 # frames added before and after every corrupt range
+MERGE = 5 # ranges at most this many frames apart are merged
+MAD_FLOOR = {'position': 5.0, 'speed': 2.0, 'acceleration': 2.0, 'rigid': 5.0} # in mm (per frame), so noise on very still markers is not an outlier
+
+# markers on the same rigid body
+SEGMENTS = {
+    'head': ['LFHD', 'RFHD', 'LBHD', 'RBHD'],
+    'pelvis': ['LASI', 'RASI', 'LPSI', 'RPSI'],
+    'left wrist': ['LWRA', 'LWRB'],
+    'right wrist': ['RWRA', 'RWRB'],
+}
+
+
+def main(c3ds_dirs, report_path, workers=1):
+    files = collect_c3d_files(c3ds_dirs)
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(tqdm(executor.map(detect_file_safe, files), total=len(files)))
+    else:
+        results = [detect_file_safe(f) for f in tqdm(files)]
+
+    settings = {'window': WINDOW, 'z_threshold': Z_THRESHOLD, 'min_markers': MIN_MARKERS, 'pad': PAD, 'merge': MERGE, 'mad_floor': MAD_FLOOR, 'segments': SEGMENTS}
+    report = {'settings': settings, 'files': dict(results)}
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent=4)
+
+    affected = {path: result['ranges'] for path, result in report['files'].items() if result.get('ranges')}
+    print(f'{len(affected)} of {len(files)} files have corrupt segments, report written to {report_path}')
+    for path, ranges in affected.items():
+        print(f'{path}: {[tuple(r) for r in ranges]}')
+    for path, result in report['files'].items():
+        if 'error' in result: print(f'FAILED {path}: {result["error"]}')
+    return report
+
+
+def load_affected_files(report_path):
+    # the detected ranges of a report, as in handle_S3_jumpingjacks.AFFECTED_FILES
+    with open(report_path) as file:
+        report = json.load(file)
+    return {path: [tuple(r) for r in result['ranges']] for path, result in report['files'].items() if result.get('ranges')}
+
+
+def detect_file_safe(c3d_file_path):
+    result = {}
+    with record_error(result):
+        trial = Trial(c3d_file_path)
+        result.update(detect_corrupt(trial.points[:, :len(trial.marker_names)], trial.marker_names))
+    return str(c3d_file_path), result
+
+
+def detect_corrupt(points, marker_names):
+    """Corrupt frame ranges of a (3, n_markers, n_frames) array, and what triggered them"""
+    scores = marker_scores(points)
+    outlier = np.max(list(scores.values()), axis=0) > Z_THRESHOLD # (n_markers, n_frames)
+    rigid_scores, pairs = rigid_segment_scores(points, marker_names)
+    rigid_violation = rigid_scores > Z_THRESHOLD
+
+    corrupt = (outlier.sum(axis=0) >= MIN_MARKERS) | rigid_violation.any(axis=0)
+    ranges = frame_ranges(corrupt, PAD, MERGE)
+
+    details = []
+    for start, end in ranges:
+        frames = slice(start, end + 1)
+        details.append({
+            'range': [start, end],
+            'markers': [marker_names[m] for m in np.nonzero(outlier[:, frames].any(axis=1))[0]],
+            'rigid_pairs': [pairs[p] for p in np.nonzero(rigid_violation[:, frames].any(axis=1))[0]],
+            'max_z': {name: round(float(np.nanmax(score[:, frames], initial=0)), 1) for name, score in scores.items()},
+        })
+    return {'ranges': ranges, 'frames': int(corrupt.sum()), 'details': details}
+
+
+def marker_scores(points):
+    # robust z-scores (n_markers, n_frames) of every marker feature
+    filled, _ = interpolate_nan_linear_batch(points) # the median filter does not skip NaN
+    missing = np.isnan(points).any(axis=0)
+
+    deviation = np.linalg.norm(filled - median_filter(filled, size=(1, 1, WINDOW), mode='nearest'), axis=0)
+    velocity = np.diff(filled, axis=-1, prepend=filled[..., :1])
+    speed = np.linalg.norm(velocity, axis=0)
+    acceleration = np.linalg.norm(np.diff(velocity, axis=-1, prepend=velocity[..., :1]), axis=0)
+
+    scores = {}
+    for name, feature in [('position', deviation), ('speed', speed), ('acceleration', acceleration)]:
+        score = robust_zscore(feature, MAD_FLOOR[name])
+        score[missing] = np.nan
+        scores[name] = score
+    return scores
+
+
+def rigid_segment_scores(points, marker_names):
+    # robust z-scores (n_pairs, n_frames) of the distances between markers of the same segment
+    indices = {name: i for i, name in enumerate(marker_names)}
+    pairs = [(a, b) for markers in SEGMENTS.values() for i, a in enumerate(markers) for b in markers[i + 1:] if a in indices and b in indices]
+    if len(pairs) == 0:
+        return np.zeros((0, points.shape[-1])), pairs
+
+    a, b = np.array([[indices[a], indices[b]] for a, b in pairs]).T
+    distances = np.linalg.norm(points[:, a] - points[:, b], axis=0)
+    missing = np.isnan(distances)
+    filled, _ = interpolate_nan_linear_batch(distances[np.newaxis])
+    score = robust_zscore(filled[0], MAD_FLOOR['rigid'])
+    score[missing] = np.nan
+    return score, pairs
+
+
+def robust_zscore(feature, mad_floor):
+    # |feature - rolling median| / rolling MAD, along the last axis
+    size = (1,) * (feature.ndim - 1) + (WINDOW,)
+    median = median_filter(feature, size=size, mode='nearest')
+    deviation = np.abs(feature - median)
+    mad = 1.4826 * median_filter(deviation, size=size, mode='nearest')
+    return deviation / np.maximum(mad, mad_floor)
+
+
+def frame_ranges(corrupt, pad=0, merge=0):
+    # (start, end) ranges of the True frames, padded by `pad` frames and merged when at most `merge` frames apart
+    ranges = []
+    for start, end in group_intervals(np.nonzero(corrupt)[0]):
+        start, end = max(start - pad, 0), min(end + pad, len(corrupt) - 1)
+        if ranges and start - ranges[-1][1] <= merge + 1:
+            ranges[-1] = [ranges[-1][0], end]
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detect corrupt segments in c3d files")
+    parser.add_argument('c3ds_dirs', type=str, nargs='+', help="Path(s) to the directories containing .c3d files")
+    parser.add_argument('--report', type=str, default='corrupt_report.json', help="Json report of the detected ranges (default: corrupt_report.json)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes (default: 1)")
+    args = parser.parse_args()
+
+    main(args.c3ds_dirs, args.report, args.workers)
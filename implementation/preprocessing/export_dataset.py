@@ -0,0 +1,26 @@
+import sys
+sys.path.append("..//implementation")
+
+import argparse
+from helper.dataset_store import export_dataset
+from helper.batch import collect_c3d_files
+
+# Consolidate the preprocessed c3d files (output of fix_c3d_folder.py) into one memory mapped store, see helper/dataset_store.py
+
+
+def main(c3ds_dirs, store_dir):
+    c3d_paths = collect_c3d_files(c3ds_dirs, unique='stem') # the trials are looked up by name in the store
+    if len(c3d_paths) == 0:
+        print(f'No .c3d files in {", ".join(map(str, c3ds_dirs))}, nothing exported')
+        return None
+    index = export_dataset(c3d_paths, store_dir)
+    print(f"Exported {len(index['trials'])} trials ({index['n_frames']} frames) to {store_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export preprocessed c3d files to a memory mapped dataset store")
+    parser.add_argument('c3ds_dirs', type=str, nargs='+', help="Path(s) to the directories containing the preprocessed .c3d files")
+    parser.add_argument('store_dir', type=str, help="Path to the output directory of the store")
+    args = parser.parse_args()
+
+    main(args.c3ds_dirs, args.store_dir)
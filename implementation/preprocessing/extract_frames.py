@@ -0,0 +1,174 @@
+import sys
+sys.path.append("..//implementation")
+
+from pathlib import Path
+from os import replace
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+import argparse
+import hashlib
+import json
+import shutil
+import subprocess
+import tarfile
+import time
+
+from helper.alignment import CAMERAS, alignment_path, load_alignment, aligned_frames
+from helper.util import SKIPPED_TRIALS, group_intervals, parse_trial_name
+from helper.batch import record_error, load_manifest, update_manifest
+
+# Extract the frames of all videos of the MPC dataset as JPEG images, replaces Scripts/vid_to_img.ps1
+# Only the frames that have a pose in the alignment index of the trial (S<n>/joints_3d/<trial>.align.npz, written by
+# osim_to_json.py) are extracted, the others are never used. Every video is one ffmpeg process, `workers` of them run at once.
+# Frames keep their number in the video: S<n>/images/<video>/0042.jpg, or S<n>/images/<video>.tar with --shards.
+
+DATA_DIR = Path('F:/MPC') # Location of the MPC dataset on your machine
+SUBJECTS = range(1, 9)
+MANIFEST_NAME = 'extract_manifest.json' # per-video success/failure record, written to the output directory
+QUALITY = 2 # -q:v of ffmpeg, 2 is high quality, lower number means better quality
+
+
+def main(data_dir=DATA_DIR, subjects=SUBJECTS, out_dir=None, workers=4, quality=QUALITY, shards=False, all_frames=False, force=False):
+    if shutil.which('ffmpeg') is None:
+        raise RuntimeError('ffmpeg was not found, install it and add it to the PATH')
+    out_dir = Path(out_dir or data_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = Path(out_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+
+    tasks, skipped = video_tasks(data_dir, subjects, out_dir, all_frames)
+    for name, reason in skipped.items():
+        manifest[name] = {'status': 'skipped', 'error': reason}
+    if not force:
+        # skip the videos that were extracted with the same frames and settings
+        up_to_date = [t for t in tasks if is_up_to_date(manifest.get(t['name']), t, quality, shards)]
+        tasks = [t for t in tasks if t not in up_to_date]
+        if up_to_date: print(f'{len(up_to_date)} videos are up to date (use --force to extract them again)')
+
+    # the work is done by the ffmpeg processes, threads only wait for them
+    with ThreadPoolExecutor(workers) as executor:
+        results = executor.map(extract_video_safe, tasks, repeat(quality), repeat(shards))
+        update_manifest(manifest, manifest_path, results, len(tasks))
+
+    failed = [t['name'] for t in tasks if manifest[t['name']]['status'] == 'failed']
+    print(f'{len(tasks) - len(failed)} of {len(tasks)} videos extracted, {len(skipped)} skipped, manifest written to {manifest_path}')
+    for name in failed:
+        print(f'FAILED {name}: {manifest[name]["error"]}')
+    return manifest
+
+
+def video_tasks(data_dir, subjects, out_dir, all_frames=False):
+    # the videos to extract and the frames of each, and the reason of every skipped video
+    tasks, skipped = [], {}
+    for subject_id in subjects:
+        video_dir = Path(data_dir, f'S{subject_id}', 'videos')
+        if not video_dir.is_dir(): continue
+        for video in sorted(video_dir.glob('*.mp4')):
+            name = f'S{subject_id}/{video.stem}'
+            trial_name, _, camera = video.stem.rpartition('_')
+            try:
+                trial = parse_trial_name(trial_name)
+            except ValueError:
+                trial = None
+            if camera not in CAMERAS or trial is None:
+                skipped[name] = 'not named <subject>_<action>_<variation>_<camera>.mp4 by rename_mp4s.ps1'
+                continue
+            if trial in SKIPPED_TRIALS:
+                skipped[name] = 'skipped trial'
+                continue
+
+            frames = None # all frames
+            if not all_frames:
+                align_path = alignment_path(Path(data_dir, f'S{subject_id}', 'joints_3d', trial_name + '.json'))
+                if not align_path.is_file():
+                    skipped[name] = f'no alignment index {align_path}, run osim_to_json.py first or use --all_frames'
+                    continue
+                frames = aligned_frames(load_alignment(align_path), camera).tolist()
+            tasks.append({'name': name, 'video': str(video), 'frames': frames, 'out': str(Path(out_dir, f'S{subject_id}', 'images', video.stem))})
+    return tasks, skipped
+
+
+def task_hash(task, quality, shards):
+    # everything that changes the extracted images
+    config = {'frames': task['frames'], 'quality': quality, 'shards': shards}
+    return hashlib.sha256(json.dumps(config).encode()).hexdigest()
+
+
+def video_stamp(video):
+    stat = Path(video).stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def output_path(task, shards):
+    return Path(task['out'] + '.tar') if shards else Path(task['out'])
+
+
+def is_up_to_date(entry, task, quality, shards):
+    if entry is None or entry['status'] != 'ok' or entry.get('config_hash') != task_hash(task, quality, shards):
+        return False
+    return output_path(task, shards).exists() and entry.get('video_stamp') == video_stamp(task['video'])
+
+
+def extract_video_safe(task, quality=QUALITY, shards=False):
+    # Extract one video and report the outcome instead of raising, so one bad video does not stop the run
+    start = time.perf_counter()
+    entry = {'input': task['video'], 'output': str(output_path(task, shards)), 'status': 'ok', 'error': None,
+             'video_stamp': video_stamp(task['video']), 'config_hash': task_hash(task, quality, shards)}
+    with record_error(entry):
+        entry['frames'] = extract_video(task['video'], task['out'], task['frames'], quality, shards)
+    entry['seconds'] = round(time.perf_counter() - start, 2)
+    return task['name'], entry
+
+
+def extract_video(video, out, frames=None, quality=QUALITY, shards=False):
+    """Extract frames (all if None) of a video to the folder `out`, or to out.tar. Returns the number of frames"""
+    out = Path(out)
+    tmp_dir = out.with_name(f'.{out.name}.tmp') # nothing is visible under the final name before the video is done
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', str(video)]
+    if frames is not None:
+        if len(frames) == 0:
+            raise ValueError('no frame of the video is aligned to the joints')
+        # one decoding pass, only the frames in the ranges are encoded. ffmpeg stops after the last one
+        ranges = '+'.join(f'between(n,{start},{end})' for start, end in group_intervals(frames))
+        command += ['-vf', f"select='{ranges}'", '-vsync', '0', '-frames:v', str(len(frames))]
+    command += ['-q:v', str(quality), '-start_number', '0', str(Path(tmp_dir, '%06d.jpg'))]
+    subprocess.run(command, check=True, capture_output=True, text=True)
+
+    # the images are numbered in order of extraction, rename them to their frame in the video
+    images = sorted(tmp_dir.glob('*.jpg'))
+    if frames is None:
+        frames = range(len(images))
+    elif len(images) != len(frames):
+        raise RuntimeError(f'ffmpeg extracted {len(images)} frames instead of {len(frames)}, the video is shorter than the joints')
+
+    if shards:
+        tmp_tar = tmp_dir.with_suffix('.tar')
+        with tarfile.open(tmp_tar, 'w') as tar:
+            for image, frame in zip(images, frames):
+                tar.add(image, arcname=f'{out.name}/{frame:04d}.jpg')
+        replace(tmp_tar, out.with_suffix('.tar'))
+        shutil.rmtree(tmp_dir)
+    else:
+        for image, frame in zip(images, frames):
+            image.rename(Path(tmp_dir, f'{frame:04d}.jpg'))
+        shutil.rmtree(out, ignore_errors=True)
+        replace(tmp_dir, out)
+    return len(images)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the video frames of the MPC dataset that are aligned to the joints as JPEG images")
+    parser.add_argument('--data_dir', type=Path, default=DATA_DIR, help=f"Location of the MPC dataset, containing S1, S2, ... (default: {DATA_DIR})")
+    parser.add_argument('--subjects', type=int, nargs='+', default=list(SUBJECTS), help="Subject ids to extract (default: all)")
+    parser.add_argument('--out_dir', type=Path, default=None, help="Write S<n>/images/ and the manifest here instead of to the data_dir")
+    parser.add_argument('--workers', type=int, default=4, help="Number of ffmpeg processes running at once (default: 4)")
+    parser.add_argument('--quality', type=int, default=QUALITY, help=f"JPEG quality, -q:v of ffmpeg (default: {QUALITY})")
+    parser.add_argument('--shards', action='store_true', help="Write one uncompressed .tar file per video instead of a folder of images")
+    parser.add_argument('--all_frames', action='store_true', help="Extract all frames, also of trials without an alignment index")
+    parser.add_argument('--force', action='store_true', help="Extract all videos again, also those that are up to date")
+    args = parser.parse_args()
+
+    main(args.data_dir, args.subjects, args.out_dir, args.workers, args.quality, args.shards, args.all_frames, args.force)
@@ -2,80 +2,290 @@ import sys
 sys.path.append("..//implementation")
 
 from pathlib import Path
-from os import listdir
-from os.path import isfile, join
-import ezc3d
+from os import replace
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+from threadpoolctl import threadpool_limits
+import hashlib
+import json
+import time
 import numpy as np
-from experiments.plot import get_marker_names, get_keypoints, plot_multi, plot_single
-from scipy.ndimage import gaussian_filter1d
+from numpy.lib.format import open_memmap
+import matplotlib
+from experiments.plot import plot_multi, plot_single
 from tqdm import tqdm
 import argparse
-from helper.interpolate import interpolate_missing
+from helper.pipeline import run_pipeline
+from helper.util import Trial, parse_trial_name
+from helper.dataset_store import imputation_path, write_imputation
+from helper.gpr_cache import HyperparameterCache
+from helper.c3d_stream import C3DReader, C3DWriter, can_stream
+from helper.batch import collect_c3d_files, record_error, load_manifest, update_manifest
+from helper import profiling
+
+MANIFEST_NAME = 'fix_manifest.json' # per-file success/failure record, written to the output directory
+GPR_OPTIONS = {'method': 'gpr', 'use': 5, 'window': None, 'multi_output': False, 'share_markers': False, 'cache': None}
+SMOOTH_FACT = 3 # sigma of the gaussian filter, in frames
+LINEAR_MARKERS = ['RASI', 'LASI'] # interpolated linearly instead of with the GPR
+PIPELINE_VERSION = 3 # increment when fix_file changes its output, so all files are rebuilt
+CONTEXT_FRAMES = 500 # frames before and after every chunk that are imputed with it, see fix_file_chunked
+
+# Main function to process all .c3d files in one or more folders (e.g. the c3ds folder of every subject)
+def main(c3ds_dirs, out_dir, do_plot=False, workers=1, retry_failed=False, gpr_options=None, force=False, plot_dir=None, chunk_frames=None):
+    if gpr_options and gpr_options.get('share_markers') and gpr_options.get('cache'):
+        raise ValueError('share_markers and cache both warm-start the GPR, use only one of them')
+    if isinstance(c3ds_dirs, (str, Path)): c3ds_dirs = [c3ds_dirs]
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    if plot_dir:
+        Path(plot_dir).mkdir(parents=True, exist_ok=True)
+        matplotlib.use('Agg') # plots are saved, not shown
+    manifest_path = Path(out_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+
+    if retry_failed:
+        files = [Path(entry['input']) for entry in manifest.values() if entry['status'] == 'failed']
+    else:
+        files = collect_c3d_files(c3ds_dirs, unique='name') # all outputs are written to the same folder
+    if not force:
+        # skip the outputs that were built from the same input with the same configuration
+        up_to_date = [f for f in files if is_up_to_date(manifest.get(f.name), f, out_dir, gpr_options, chunk_frames)]
+        files = [f for f in files if f not in up_to_date]
+        if up_to_date: print(f'{len(up_to_date)} files are up to date (use --force to rebuild them)')
+
+    if workers > 1:
+        # one file per task, results are yielded in input order
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(plot_dir is not None,)) as executor:
+            results = executor.map(fix_file_safe, files, repeat(out_dir), repeat(do_plot), repeat(gpr_options), repeat(plot_dir), repeat(chunk_frames))
+            update_manifest(manifest, manifest_path, until_broken(results, files, gpr_options, chunk_frames), len(files))
+    else:
+        results = map(fix_file_safe, files, repeat(out_dir), repeat(do_plot), repeat(gpr_options), repeat(plot_dir), repeat(chunk_frames))
+        update_manifest(manifest, manifest_path, results, len(files))
+
+    failed = [f.name for f in files if manifest[f.name]['status'] == 'failed']
+    print(f'{len(files) - len(failed)} of {len(files)} files fixed, manifest written to {manifest_path}')
+    for name in failed:
+        print(f'FAILED {name}: {manifest[name]["error"]}')
+    return manifest
+
+
+def init_worker(headless=False):
+    # every worker process runs one file at a time, so avoid oversubscribing the cores with BLAS threads
+    threadpool_limits(1)
+    if headless: matplotlib.use('Agg')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def config_hash(gpr_options=None, chunk_frames=None):
+    # everything that changes the output of fix_file. The hyperparameter cache is left out, so turning it on or off
+    # does not rebuild every file: a warm start can converge to a different optimum than the cold start, but so can
+    # two cold starts, as the optimizer restarts are not seeded
+    gpr_options = {k: v for k, v in {**GPR_OPTIONS, **(gpr_options or {})}.items() if k != 'cache'}
+    config = {'version': PIPELINE_VERSION, 'stages': pipeline_stages(gpr_options), 'gpr': gpr_options}
+    if chunk_frames: config['chunks'] = [chunk_frames, CONTEXT_FRAMES]
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def is_up_to_date(entry, c3d_file_path: Path, out_dir, gpr_options=None, chunk_frames=None):
+    if entry is None or entry['status'] != 'ok' or entry.get('config_hash') != config_hash(gpr_options, chunk_frames):
+        return False
+    outpath = Path(out_dir, c3d_file_path.name)
+    if not outpath.is_file() or not imputation_path(outpath).is_file():
+        return False
+    return entry.get('input_sha256') == file_sha256(c3d_file_path)
+
+
+def fix_file_safe(c3d_file_path: Path, out_dir: Path, do_plot=False, gpr_options=None, plot_dir=None, chunk_frames=None):
+    # Process one file and report the outcome instead of raising, so one bad file does not stop the run
+    start = time.perf_counter()
+    entry = {'input': str(c3d_file_path), 'status': 'ok', 'error': None, 'input_sha256': None, 'config_hash': config_hash(gpr_options, chunk_frames)}
+    with record_error(entry):
+        entry['input_sha256'] = file_sha256(c3d_file_path) # before processing, so a file changed meanwhile is rebuilt next time
+        chunked = bool(chunk_frames) and can_stream(c3d_file_path)
+        with profiling.context(file=c3d_file_path.name), profiling.stage('file', chunked=chunked):
+            if chunked:
+                fix_file_chunked(c3d_file_path, out_dir, gpr_options, chunk_frames)
+            else:
+                fix_file(c3d_file_path, out_dir, do_plot, gpr_options, plot_dir) # whole file, also if it cannot be streamed
+        if chunked: entry['chunked'] = True
+    entry['seconds'] = round(time.perf_counter() - start, 2)
+    return c3d_file_path.name, entry
+
+
+def until_broken(results, files, gpr_options=None, chunk_frames=None):
+    # the results of executor.map in input order. If a worker dies (e.g. killed for running out of memory), the pool
+    # is broken and yields no more results, then all files without a result are reported failed instead
+    done = 0
+    try:
+        for result in results:
+            yield result
+            done += 1
+    except BrokenProcessPool as e:
+        for c3d_file_path in files[done:]:
+            yield c3d_file_path.name, {'input': str(c3d_file_path), 'status': 'failed', 'input_sha256': None, 'config_hash': config_hash(gpr_options, chunk_frames),
+                                       'error': f'BrokenProcessPool: a worker process died while this file was pending or running ({e})'}
 
-# Main function to process all .c3d files in a folder
-def main(c3ds_dir, out_dir, do_plot=False):
-    for f in tqdm(listdir(c3ds_dir)):
-        fullpath = Path(join(c3ds_dir, f))
-        assert isfile(fullpath)
-        fix_file(fullpath, out_dir, do_plot)
 
 # Function to process a single .c3d file
-def fix_file(c3d_file_path: Path, out_dir: Path, do_plot=False):
+# gpr_options overrides GPR_OPTIONS: method is 'gpr' or 'kalman' (same model, linear in the number of frames),
+# use decimates the markers before imputation (see interpolate_missing), window and multi_output are passed to interpolate_nan_gpr,
+# share_markers warm-starts every marker from the hyperparameters learned for the previous one,
+# cache (path of a HyperparameterCache) warm-starts from the same marker in earlier trials of the subject and action,
+# it cannot be combined with share_markers
+def fix_file(c3d_file_path: Path, out_dir: Path, do_plot=False, gpr_options=None, plot_dir=None):
     outpath = Path(f'{out_dir}/{c3d_file_path.stem}{c3d_file_path.suffix}')
 
-    marker_names = get_marker_names(str(c3d_file_path))
-    c3d = ezc3d.c3d(str(c3d_file_path))
-    point_data_old = c3d['data']['points']
-    point_data = np.empty_like(point_data_old)
-    marker_count = len(c3d['parameters']['POINT']['LABELS']['value'])
-
-    for i, marker_name in enumerate(marker_names):
-        x, y, z = get_keypoints(str(c3d_file_path), i)
-
-        smooth_fact = 3
-        x = gaussian_filter1d(x, smooth_fact)
-        y = gaussian_filter1d(y, smooth_fact)
-        z = gaussian_filter1d(z, smooth_fact)
-
-        if marker_name in ['RASI', 'LASI']:
-            x, y, z, missing_indices = interpolate_missing(x, y, z, 'linear')
-        else:
-            x, y, z, missing_indices = interpolate_missing(x, y, z, 'gpr', 1, 5)
-
-        point_data[0, i, :] = x
-        point_data[1, i, :] = y
-        point_data[2, i, :] = z
-
-    if do_plot:
-        plot_multi(str(c3d_file_path), marker_names, 'none')
-    del c3d['data']['points']
-    c3d['data']['points'] = point_data
+    with profiling.stage('parse'):
+        trial = Trial(c3d_file_path) # parse the file only once
+    marker_names = trial.marker_names
+    c3d = trial.c3d
+
+    def sheet_path(kind):
+        # with plot_dir, the plots are saved to <plot_dir>/<stem>_raw.png and _fixed.png instead of shown
+        return Path(plot_dir, f'{c3d_file_path.stem}_{kind}.png') if plot_dir else None
+    if do_plot or plot_dir:
+        with profiling.stage('plot'):
+            plot_multi(trial, marker_names, 'none', out_path=sheet_path('raw'))
+
+    with ImputationContext(c3d_file_path, gpr_options) as context:
+        fixed, observed, std = fix_points(trial.points[:, :len(marker_names)], marker_names, context)
+    # the fixed markers replace the captured ones in place, instead of in a second copy of all points
+    point_data = c3d['data']['points']
+    point_data[:3, :len(marker_names), :] = fixed
     del c3d['data']['meta_points']['residuals']
     del c3d['data']['meta_points']['camera_masks']
-    c3d['parameters']['POINT']['LABELS']['value'] = c3d['parameters']['POINT']['LABELS']['value'][:marker_count]
 
     # Write the data
-    c3d.write(str(outpath))
-    if do_plot:
-        plot_multi(str(outpath), marker_names)
+    with profiling.stage('write'):
+        c3d.write(str(outpath))
+        imputed = ~observed & ~np.isnan(fixed[1])
+        write_imputation(imputation_path(outpath), observed, imputed, std)
+    if do_plot or plot_dir:
+        with profiling.stage('plot'):
+            plot_multi(Trial(outpath), marker_names, out_path=sheet_path('fixed'))
+
+
+def fix_file_chunked(c3d_file_path: Path, out_dir: Path, gpr_options=None, chunk_frames=6000, context_frames=CONTEXT_FRAMES):
+    # like fix_file, but the points are read, fixed and written `chunk_frames` frames at a time (see helper/c3d_stream.py),
+    # so the memory does not grow with the length of the trial. Every chunk is smoothed and imputed together with
+    # `context_frames` frames before and after it, gaps longer than that are imputed from one side only.
+    outpath = Path(f'{out_dir}/{c3d_file_path.stem}{c3d_file_path.suffix}')
+    with profiling.stage('parse'):
+        reader = C3DReader(c3d_file_path)
+    marker_names = reader.marker_names
+    n_markers = len(marker_names)
+
+    observed = np.zeros((n_markers, reader.n_frames), dtype=bool)
+    imputed = np.zeros((n_markers, reader.n_frames), dtype=bool)
+    std_path = Path(out_dir, f'.{c3d_file_path.stem}.std.npy')
+    tmp_path = Path(out_dir, f'.{outpath.name}.tmp') # nothing is visible under the final name before the file is complete
+    std = open_memmap(std_path, mode='w+', dtype=np.float32, shape=(3, n_markers, reader.n_frames)) # on disk, not in memory
+
+    try:
+        with ImputationContext(c3d_file_path, gpr_options) as context, C3DWriter(tmp_path, reader) as writer:
+            for start, stop, points in reader.chunks(chunk_frames, context_frames):
+                with profiling.context(chunk=start):
+                    fixed, chunk_observed, chunk_std = fix_points(points[:, :n_markers], marker_names, context)
+                first = max(start - context_frames, 0)
+                frames = slice(start - first, stop - first) # the chunk without its context
+                points[:, :n_markers] = fixed
+                with profiling.stage('write', chunk=start):
+                    writer.write(points[..., frames])
+                observed[:, start:stop] = chunk_observed[:, frames]
+                imputed[:, start:stop] = ~chunk_observed[:, frames] & ~np.isnan(fixed[1, :, frames])
+                std[..., start:stop] = chunk_std[..., frames]
+
+        with profiling.stage('write'):
+            write_imputation(imputation_path(outpath), observed, imputed, std)
+        replace(tmp_path, outpath)
+    finally:
+        del std # close the memmap, open files cannot be removed on Windows
+        std_path.unlink(missing_ok=True)
+        tmp_path.unlink(missing_ok=True)
+
+
+class ImputationContext:
+    """Stages of the preprocessing of one file (from gpr_options) and the hyperparameters shared between its markers or chunks"""
+
+    def __init__(self, c3d_file_path, gpr_options=None):
+        self.stages = pipeline_stages(gpr_options)
+        gpr_options = {**GPR_OPTIONS, **(gpr_options or {})}
+        self.shared_kernels = {} if gpr_options['share_markers'] else None
+        self.cache = None
+        if gpr_options['cache']:
+            try:
+                self.subject, self.action, _ = parse_trial_name(c3d_file_path)
+                self.cache = HyperparameterCache(gpr_options['cache'])
+            except ValueError:
+                pass # cache entries are keyed by subject and action, other files are imputed without the cache
+
+    def marker_kernels(self, marker_name):
+        # hyperparameters to warm-start the GPR of a marker from
+        if self.cache is not None: return self.cache.view(self.subject, self.action, marker_name)
+        return self.shared_kernels
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.cache is not None: self.cache.save()
+
+
+def pipeline_stages(gpr_options=None):
+    # the stages of fix_points in order (see helper/pipeline.py): smoothing, then the imputation of all markers
+    gpr_options = {**GPR_OPTIONS, **(gpr_options or {})}
+    method, use = gpr_options['method'], gpr_options['use']
+    options = {} if method == 'kalman' else {'window': gpr_options['window'], 'multi_output': gpr_options['multi_output']}
+    return [
+        ('smooth', {'sigma': SMOOTH_FACT}), # NaN-aware, so the gaps do not grow
+        ('impute', {'method': 'linear', 'markers': LINEAR_MARKERS}),
+        ('impute', {'method': method, 'use': use, **options}), # all other markers
+    ]
+
+
+def fix_points(points, marker_names, context: ImputationContext):
+    """Smoothed and imputed copy of the (3, n_markers, n_frames) points, the mask of the observed frames and the std"""
+    return run_pipeline(points, marker_names, context.stages, context.marker_kernels)
 
 # Argument parser configuration
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fix C3D folder script")
-    parser.add_argument('c3ds_dir', type=str, help="Path to the directory containing .c3d files")
+    parser.add_argument('c3ds_dirs', type=str, nargs='+', help="Path(s) to the directories containing .c3d files, e.g. the c3ds folder of every subject")
     parser.add_argument('out_dir', type=str, help="Path to the output directory")
-    #parser.add_argument('--do_plot', action='store_true', help="Enable plotting (default: OFF)")
-    
+    parser.add_argument('--do_plot', action='store_true', help="Enable plotting (default: OFF)")
+    parser.add_argument('--plot_dir', type=str, default=None, help="Save the plots of every file to this folder instead of showing them (works with --workers)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes (default: 1)")
+    parser.add_argument('--gpr_method', type=str, default='gpr', choices=['gpr', 'kalman'], help="GPR backend, kalman scales linearly with the trial length (default: gpr)")
+    parser.add_argument('--gpr_use', type=int, default=5, help="Only use every nth captured frame for the GPR (default: 5)")
+    parser.add_argument('--gpr_window', type=int, default=None, help="Fit the GPR only on this many frames around each gap (default: whole trial)")
+    parser.add_argument('--gpr_multi_output', action='store_true', help="Fit x, y and z in one GPR with shared hyperparameters")
+    parser.add_argument('--gpr_share_markers', action='store_true', help="Warm-start each marker's GPR from the previous marker's hyperparameters")
+    parser.add_argument('--gpr_cache', type=str, default=None, help="Json file to warm-start the GPR from hyperparameters learned in earlier runs")
+    parser.add_argument('--retry_failed', action='store_true', help=f"Only rerun the files marked as failed in {MANIFEST_NAME} (c3ds_dirs are not scanned)")
+    parser.add_argument('--chunk_frames', type=int, default=None, help=f"Read, fix and write this many frames at a time, with {CONTEXT_FRAMES} frames of context, to bound the memory of long trials (default: whole file)")
+    parser.add_argument('--force', action='store_true', help=f"Rebuild all files, also those that {MANIFEST_NAME} lists as up to date")
+    parser.add_argument('--profile_log', type=str, default=None, help="Append the wall time, CPU time and peak memory of every stage, file and marker to this JSON lines file (see profile_summary.py)")
+    parser.add_argument('--cprofile_dir', type=str, default=None, help="With --profile_log, also run every file under cProfile and save the .prof files to this folder")
+
     args = parser.parse_args()
+    if args.do_plot and args.workers > 1 and not args.plot_dir:
+        parser.error('--do_plot blocks on every file and can only be used with --workers 1, use --plot_dir to save the plots instead')
+    if args.gpr_share_markers and args.gpr_cache:
+        parser.error('--gpr_share_markers and --gpr_cache both warm-start the GPR, use only one of them')
+    if args.chunk_frames and (args.do_plot or args.plot_dir):
+        parser.error('the plots need the whole trial in memory and cannot be used with --chunk_frames')
+    if args.cprofile_dir and not args.profile_log:
+        parser.error('--cprofile_dir needs --profile_log')
+    if args.profile_log:
+        profiling.enable(args.profile_log, args.cprofile_dir) # before the workers are started, they inherit it
 
     # Call the main function with parsed arguments
-    #main(args.c3ds_dir, args.out_dir, False)
-    main(args.c3ds_dir, args.out_dir, args.do_plot)
-# if __name__ == "__main__":
-#     # Hardcoded values for input directory and output directory
-#     c3ds_dir = "preprocessing\c3d"  # Replace with the actual path to your C3D files
-#     out_dir = "preprocessing\processedc3d"  # Replace with the actual output directory path
-#     do_plot = True  # Set to True if you want to enable plotting
-
-#     # Call the main function directly with these values
-#     main(c3ds_dir, out_dir, do_plot)
\ No newline at end of file
+    gpr_options = {'method': args.gpr_method, 'use': args.gpr_use, 'window': args.gpr_window, 'multi_output': args.gpr_multi_output, 'share_markers': args.gpr_share_markers, 'cache': args.gpr_cache}
+    main(args.c3ds_dirs, args.out_dir, args.do_plot, args.workers, args.retry_failed, gpr_options, args.force, args.plot_dir, args.chunk_frames)
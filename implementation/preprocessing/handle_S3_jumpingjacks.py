@@ -8,15 +8,18 @@ import numpy as np
 import matplotlib.pyplot as plt
 import math
 import itertools
-import ezc3d
+import argparse
 
-from helper.util import get_marker_names, get_keypoints
-from helper.plot_markers import plot_2d
+from helper.util import Trial
+from helper.plot_markers import plot_2d, show_or_save
+from helper import profiling
+from detect_corrupt import load_affected_files
 
 plt.rcParams.update({'font.size': 6})
 
 # The c3d data we captured for S3 performing jumpingjacks was corrupted.
 # Use the this script to remove the corrupt data (sets it to NaN, so it will be imputed in ./fix_c3d_folder.py).
+# The ranges were found by hand, ./detect_corrupt.py finds them automatically for the whole dataset (use --report).
 
 AFFECTED_FILES = {
     'preprocessing\c3d\S3_jumpingjacks_lighting.c3d': [
@@ -31,52 +34,61 @@ AFFECTED_FILES = {
     ],
 }
 
-def main():
-    for f, corrupted_start_end in tqdm(AFFECTED_FILES.items()):
-        print(f)
-        assert isfile(f)
-        plot_raw_c3d(f)
-        c3d = ezc3d.c3d(f)
-        point_data_old = c3d['data']['points']
-        point_data = np.empty_like(point_data_old)
+def main(affected_files=AFFECTED_FILES):
+    for f, corrupted_start_end in tqdm(affected_files.items()):
+        with profiling.context(file=f), profiling.stage('file'):
+            fix_corrupt_file(f, corrupted_start_end)
 
-        index_lists = [list(range(start, end + 1)) for start, end in corrupted_start_end]
-        corrupt_indices = list(itertools.chain.from_iterable(index_lists))
 
-        # Plot (indices that will be deleted are shown in yellow)
+def fix_corrupt_file(f, corrupted_start_end):
+    print(f)
+    assert isfile(f)
+    with profiling.stage('parse'):
+        trial = Trial(f) # parse once, plots and corrections take their markers from it
+    with profiling.stage('plot'):
+        plot_raw_c3d(trial)
+    c3d = trial.c3d
+    point_data_old = c3d['data']['points']
+    point_data = np.empty_like(point_data_old)
+
+    index_lists = [list(range(start, end + 1)) for start, end in corrupted_start_end]
+    corrupt_indices = list(itertools.chain.from_iterable(index_lists))
+
+    # Plot (indices that will be deleted are shown in yellow)
+    with profiling.stage('plot'): # includes the time the window is open
         _, axis = plt.subplots(8, 5)
+        marker_names = trial.marker_names
         for i in range(39):
-            marker_names = get_marker_names(f)
             ax = axis[math.floor(i/5), i % 5]
-            x, y, z = get_keypoints(f, i)
+            x, y, z = trial.keypoints(i)
             title = f'{marker_names[i]} ({i})'
             plot_2d(ax, title, x, y, z, [], corrupt_indices)
         plt.legend(loc='lower right')
         plt.show(block=True)
 
-        # Remove corrupt indices for all keypoints
+    # Remove corrupt indices for all keypoints
+    with profiling.stage('remove', corrupt_frames=len(corrupt_indices)):
         for i in range(39):
-            x, y, z = get_keypoints(f, i)
+            x, y, z = trial.keypoints(i)
             x, y, z = remove_corrupt_data(x, y, z, corrupt_indices) 
             point_data[0, i, :] = x
             point_data[1, i, :] = y
             point_data[2, i, :] = z
 
-        del c3d['data']['points']
-        c3d['data']['points'] = point_data
+    del c3d['data']['points']
+    c3d['data']['points'] = point_data
+    with profiling.stage('write'):
         c3d.write(f) # overwrite file
 
 # Plot the raw data (before removing corrupted indices)
-def plot_raw_c3d(f):
-    # Load the marker names and C3D data
-    marker_names = get_marker_names(f)
-    c3d = ezc3d.c3d(f)
+def plot_raw_c3d(trial, out_path=None):
+    marker_names = trial.marker_names
 
     # Create subplots for 39 markers
     _, axis = plt.subplots(8, 5, figsize=(15, 10))  # Adjust figure size
     for i in range(39):
         # Get marker coordinates (x, y, z) for each marker
-        x, y, z = get_keypoints(f, i)
+        x, y, z = trial.keypoints(i)
         title = f'{marker_names[i]} ({i})'
 
         # Plot the raw data (no corrupted indices highlighted yet)
@@ -84,7 +96,7 @@ def plot_raw_c3d(f):
         plot_2d(ax, title, x, y, z, [], [])  # Pass empty corrupt indices
     plt.tight_layout()
     plt.legend(loc='lower right')
-    plt.show(block=True)
+    show_or_save(plt.gcf(), out_path)
 
 def remove_corrupt_data(x, y, z, corrupt_indices):
     x[corrupt_indices] = np.NaN
@@ -109,9 +121,16 @@ def find_corrupt_indices_zscore(x, y, z, combined=False):
     else:
         zscore = np.max(np.transpose([abs(zscore_x), abs(zscore_y), abs(zscore_z)]), axis=1)
         corrupt_indices = np.where(zscore > single_zscore_threshold)[0]
-    missing_indices = np.argwhere(np.isnan(x)).flatten()
-    return list(set(corrupt_indices) | set(missing_indices)) # return corrupt and missing indices
+    missing_indices = np.nonzero(np.isnan(x))[0]
+    return np.union1d(corrupt_indices, missing_indices) # return corrupt and missing indices (sorted)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Remove corrupt segments from c3d files (overwrites the files)")
+    parser.add_argument('--report', type=str, default=None, help="Use the ranges of a detect_corrupt.py report instead of AFFECTED_FILES")
+    parser.add_argument('--profile_log', type=str, default=None, help="Append the wall time, CPU time and peak memory of every stage and file to this JSON lines file (see profile_summary.py)")
+    parser.add_argument('--cprofile_dir', type=str, default=None, help="With --profile_log, also run every file under cProfile and save the .prof files to this folder")
+    args = parser.parse_args()
+    if args.profile_log: profiling.enable(args.profile_log, args.cprofile_dir)
+
+    main(load_affected_files(args.report) if args.report else AFFECTED_FILES)
\ No newline at end of file
@@ -1,88 +1,132 @@
+import sys
+sys.path.append("..//implementation")
+
 import opensim as osim
 import pandas as pd
 import numpy as np
-import json
+import math
 from tqdm import tqdm
 from itertools import product
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import argparse
+from helper.joints_io import write_joints_json, write_joints_npy
+from helper.alignment import alignment_path, trial_alignment, write_alignment
+from helper.util import SKIPPED_TRIALS
+from helper import profiling
 
-SUBJECT_ID = 3
-ADDB_DIR_PATH = f'F:/MPC/S{SUBJECT_ID}/addb_results'
-JSON_DIR_PATH = f'F:/MPC/S{SUBJECT_ID}/joints_3d'
+DATA_DIR = Path('F:/MPC') # Location of the MPC dataset on your machine
+SUBJECTS = range(1, 9)
+MOCAP_FPS = 100 # frame rate of the marker data
+STRIDE = 2 # keep every second frame, as marker data was captured with 100FPS, and videos at 50FPS
 
 
 # Convert captured .osim and (mutliple) .mot files to one .json file 
 
-def main():
-    addb_to_json(ADDB_DIR_PATH, JSON_DIR_PATH, SUBJECT_ID)
+def main(data_dir=DATA_DIR, subjects=SUBJECTS, workers=1, precision=None, indent=None, out_format='json', stride=STRIDE):
+    tasks = []
+    for subject_id in subjects:
+        subject_dir = Path(data_dir, f'S{subject_id}')
+        tasks += trial_tasks(Path(subject_dir, 'addb_results'), Path(subject_dir, 'joints_3d'), subject_id, Path(subject_dir, 'videos'))
+    run_tasks(tasks, workers, precision=precision, indent=indent, out_format=out_format, stride=stride)
+
+
+def addb_to_json(addb_dir, json_dir, subject_id, workers=1, precision=None, indent=None, out_format='json', video_dir=None, stride=STRIDE):
+    run_tasks(trial_tasks(addb_dir, json_dir, subject_id, video_dir), workers, precision=precision, indent=indent, out_format=out_format, stride=stride)
 
 
-def addb_to_json(addb_dir, json_dir, subject_id):
+def run_tasks(tasks, workers=1, **kwargs):
+    # kwargs are passed on to parse_mot_osim
+    parse = partial(parse_mot_osim, **kwargs)
+    if workers > 1:
+        # every worker loads each model once (load_model) and then converts many trials with it. The tasks are in order
+        # of subject and handed out in consecutive chunks, about two per worker, so a worker sees only a few models
+        chunksize = max(1, math.ceil(len(tasks) / (2 * workers)))
+        with ProcessPoolExecutor(workers) as executor:
+            list(tqdm(executor.map(parse, *zip(*tasks), chunksize=chunksize), total=len(tasks)))
+    else:
+        for task in tqdm(tasks):
+            parse(*task)
+
+
+def trial_tasks(addb_dir, json_dir, subject_id, video_dir=None):
+    # (mot_file1, mot_file2, osim_file, json_file, video_dir) of every trial of one subject
+    Path(json_dir).mkdir(parents=True, exist_ok=True)
     actions = ['conversation', 'drinking', 'freestyle', 'jumpingjacks', 'shoelaces', 'walking']
     variations = ['normal', 'object', 'person', 'lighting']
     trials = [(a, v) for a, v in product(actions, variations)]
 
     osim_file = Path(addb_dir, 'Models', 'match_markers_but_ignore_physics.osim')
-    for action, variation in tqdm(trials):
-        if SUBJECT_ID == 3 and action == 'jumpingjacks' and variation == 'normal': continue # skip poor quality capture
+    tasks = []
+    for action, variation in trials:
+        if (f's{subject_id}', action, variation) in SKIPPED_TRIALS: continue
         file_basename = f's{subject_id}_{action}_{variation}'
         mot_file1 = Path(addb_dir, 'IK', file_basename + '_segment_0_ik.mot')
         mot_file2 = Path(addb_dir, 'IK', file_basename + '_segment_1_ik.mot') # potentially does not exist
         json_file = Path(json_dir, file_basename + '.json')
+        tasks.append((mot_file1, mot_file2, osim_file, json_file, video_dir))
+    return tasks
+
+
+_models = {}
+def load_model(osim_file):
+    # the model is the same for all trials of a subject, so it is loaded and initialized once per process
+    key = str(osim_file)
+    if key not in _models:
+        model = osim.Model(key)
+        _models[key] = (model, model.initSystem())
+    return _models[key]
+
 
-        parse_mot_osim(mot_file1, mot_file2, osim_file, json_file)
+def parse_mot_osim(mot_file1: Path, mot_file2: Path, osim_file: Path, json_out_file: Path, video_dir=None, precision=None, indent=None, out_format='json', stride=STRIDE):
+    with profiling.context(file=Path(json_out_file).name), profiling.stage('file'):
+        convert_trial(mot_file1, mot_file2, osim_file, json_out_file, video_dir, precision, indent, out_format, stride)
 
 
-def parse_mot_osim(mot_file1: Path, mot_file2: Path, osim_file: Path, json_out_file: Path):
-    # Create dataframe with marker positions
-    model = osim.Model(str(osim_file))
+def convert_trial(mot_file1, mot_file2, osim_file, json_out_file, video_dir=None, precision=None, indent=None, out_format='json', stride=STRIDE):
+    # Compute marker positions
+    with profiling.stage('load_model'): # only the first trial of a model in every process loads it
+        model, default_state = load_model(osim_file)
+    state = osim.State(default_state) # coordinates missing in the .mot file keep their defaults, not the values of the previous trial
     
     in_degrees = check_in_degrees(str(mot_file1))
     
-    motion_data = osim.TimeSeriesTable(str(mot_file1))
-    pos_df, marker_set_names = get_marker_positions(motion_data, model, in_degrees=in_degrees) #, marker_list=marker_list)
+    with profiling.stage('kinematics', segment=0) as record:
+        motion_data = osim.TimeSeriesTable(str(mot_file1))
+        positions, times, marker_set_names = get_marker_array(motion_data, model, in_degrees=in_degrees, state=state) #, marker_list=marker_list)
+        record['frames'] = len(times)
 
     if mot_file2.is_file(): # handle second mot file, when motion data was segmented
-        motion_data2 = osim.TimeSeriesTable(str(mot_file2))
-        pos_df2, _ = get_marker_positions(motion_data2, model, in_degrees=in_degrees)
-        pos_df2['frame'] += len(pos_df) # start frame after last frame of first segment (usually frame 2000)
-        pos_df = pd.concat([pos_df, pos_df2])
-
-    # delete every second frame, as marker data was captured with 100FPS, and videos at 50FPS
-    pos_df = pos_df.iloc[::2].reset_index(drop=True)
-    pos_df['frame'] = (pos_df['frame'] / 2).astype(int) # adjust the frames accordingly
-
-    pos_df.set_index('frame', inplace=True)
-    pos_df.drop('time', axis=1, inplace=True)
-
-    for marker_name in marker_set_names:
-        pos_df[marker_name] = pos_df[[f'{marker_name}_x', f'{marker_name}_y', f'{marker_name}_z']].apply(lambda row: list(row), axis=1)
-        pos_df.drop([f'{marker_name}_x', f'{marker_name}_y', f'{marker_name}_z'], axis=1, inplace=True)
-
-    df_melted = pos_df.reset_index().melt(id_vars="frame", var_name="keypoint", value_name="position")
-
-    # Convert MultiIndex DataFrame to a nested dictionary
-    nested_dict = (
-        df_melted
-        .groupby('frame')
-        .apply(lambda group: group.set_index('keypoint').to_dict(orient='index'), include_groups=False)
-        .to_dict()
-    )
+        with profiling.stage('kinematics', segment=1) as record:
+            motion_data2 = osim.TimeSeriesTable(str(mot_file2))
+            positions2, times2, _ = get_marker_array(motion_data2, model, in_degrees=in_degrees, state=state)
+            record['frames'] = len(times2)
+        positions = np.concatenate([positions, positions2]) # frames of the second segment follow the first (usually from frame 2000)
+        times = np.concatenate([times, times2])
+
+    # keep every stride-th frame, the alignment index maps the video frames to the kept frames by their time
+    positions = positions[::stride]
+    times = times[::stride]
+    if len(times) > 1 and times[-1] > times[0]:
+        fps = (len(times) - 1) / (times[-1] - times[0])
+    else:
+        fps = MOCAP_FPS / stride # a single frame has no measurable rate, use the nominal one
 
-    # Remove superfluous attribute
-    transformed_dict = {}
-    for frame, markers in nested_dict.items():
-        transformed_dict[frame] = {
-            marker: details["position"] for marker, details in markers.items()
-        }
+    with profiling.stage('write', format=out_format):
+        if out_format in ('json', 'both'):
+            write_joints_json(json_out_file, positions, marker_set_names, precision, indent)
+        if out_format in ('npy', 'both'):
+            write_joints_npy(Path(json_out_file).with_suffix('.npy'), positions, marker_set_names, round(fps, 6))
 
-    # Write Json to file
-    with open(json_out_file, "w") as file:
-        json.dump(transformed_dict, file, indent=4)
+    # pose of every video frame of both cameras, see helper/alignment.py
+    with profiling.stage('alignment'):
+        alignments, sources = trial_alignment(times, video_dir, Path(json_out_file).stem)
+        write_alignment(alignment_path(json_out_file), times, alignments, sources)
 
 
 # adjusted from: https://github.com/perfanalytics/pose2sim/blob/main/Pose2Sim/Utilities/trc_from_mot_osim.py
-def get_marker_positions(motion_data, model, in_degrees=True, marker_list=[]):
+def get_marker_positions(motion_data, model, in_degrees=True, marker_list=[], state=None):
     '''
     Get dataframe of marker positions
     
@@ -91,11 +135,31 @@ def get_marker_positions(motion_data, model, in_degrees=True, marker_list=[]):
     - model: .osim file opened with osim.Model 
     - in_degrees: True if the motion data is in degrees, False if in radians
     - marker_list: list of marker names to include in the trc file. All if not specified
+    - state: state returned by model.initSystem(), initialized here if not specified
     
     OUTPUT:
     - marker_positions_pd: DataFrame of marker positions 
     '''
+    positions, times, marker_set_names = get_marker_array(motion_data, model, in_degrees, marker_list, state)
+    marker_set_names_xyz = np.array([[m+'_x', m+'_y', m+'_z'] for m in marker_set_names]).flatten()
+
+    marker_positions_pd = pd.DataFrame(positions.reshape(len(times), -1), columns=marker_set_names_xyz)
+    marker_positions_pd.insert(0, 'time', times)
+    marker_positions_pd.insert(0, 'frame', np.arange(len(times)))
     
+    return marker_positions_pd, marker_set_names
+
+
+def get_marker_array(motion_data, model, in_degrees=True, marker_list=[], state=None):
+    '''
+    Forward kinematics of all time steps, as arrays
+
+    OUTPUT:
+    - positions: (n_times, n_markers, 3) array of marker positions in the ground frame
+    - times: time of every row
+    - marker_set_names: names of the markers, in the order of the second axis of positions
+    '''
+
     # Markerset
     marker_set = model.getMarkerSet()
     marker_set_names = [mk.getName() for mk in list(marker_set)]
@@ -104,34 +168,37 @@ def get_marker_positions(motion_data, model, in_degrees=True, marker_list=[]):
         absent_markers = [marker for marker in marker_list if marker not in marker_set_names]
         if len(absent_markers)>0:
             print(f'The following markers were not found in the model: {absent_markers}')
-    marker_set_names_xyz = np.array([[m+'_x', m+'_y', m+'_z'] for m in marker_set_names]).flatten()
 
     # Data
-    times = motion_data.getIndependentColumn()
+    times = np.array(motion_data.getIndependentColumn())
     joint_angle_set_names = motion_data.getColumnLabels() # or [c.getName() for c in model.getCoordinateSet()]
     joint_angle_set_names = [j for j in joint_angle_set_names if not j.endswith('activation')]
-    motion_data_pd = pd.DataFrame(motion_data.getMatrix().to_numpy()[:,:len(joint_angle_set_names)], columns=joint_angle_set_names)
+    values = motion_data.getMatrix().to_numpy()[:,:len(joint_angle_set_names)].astype(float)
+    if in_degrees:
+        # translations are in meters, everything else is an angle
+        rotational = np.array([not j.endswith(('_tx', '_ty', '_tz')) for j in joint_angle_set_names], dtype=bool)
+        values[:, rotational] = np.deg2rad(values[:, rotational])
+
+    # resolve the SWIG handles once instead of looking them up by name in every time step
+    coordinate_set = model.getCoordinateSet()
+    coordinates = [coordinate_set.get(coord) for coord in joint_angle_set_names]
+    markers = [marker_set.get(mk_name) for mk_name in marker_set_names]
+    ground = model.getGround()
 
     # Get marker positions at each state
-    state = model.initSystem()
-    marker_positions = []
-    for n,t in enumerate(times):
+    if state is None: state = model.initSystem()
+    positions = np.empty((len(times), len(markers), 3))
+    for n, row in enumerate(values.tolist()):
         # put the model in the right position
-        for coord in joint_angle_set_names:
-            if in_degrees and not coord.endswith('_tx') and not coord.endswith('_ty') and not coord.endswith('_tz'):
-                value = motion_data_pd.loc[n,coord]*np.pi/180
-            else:
-                value = motion_data_pd.loc[n,coord]
-            model.getCoordinateSet().get(coord).setValue(state,value, enforceContraints=False)
+        for coordinate, value in zip(coordinates, row):
+            coordinate.setValue(state, value, False) # do not enforce constraints
         # model.assemble(state)
         model.realizePosition(state) # much faster (IK already done, no need to compute it again)
         # get marker positions
-        marker_positions += [np.array([marker_set.get(mk_name).findLocationInFrame(state, model.getGround()).to_numpy() for mk_name in marker_set_names]).flatten()]
-    marker_positions_pd = pd.DataFrame(marker_positions, columns=marker_set_names_xyz)
-    marker_positions_pd.insert(0, 'time', times)
-    marker_positions_pd.insert(0, 'frame', np.arange(len(times)))
-    
-    return marker_positions_pd, marker_set_names
+        for m, marker in enumerate(markers):
+            positions[n, m] = marker.findLocationInFrame(state, ground).to_numpy()
+
+    return positions, times, marker_set_names
 
 
 def check_in_degrees(mot_path) -> bool:
@@ -148,4 +215,17 @@ def check_in_degrees(mot_path) -> bool:
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Convert the AddBiomechanics results (.osim and .mot files) of several subjects to .json files")
+    parser.add_argument('--data_dir', type=Path, default=DATA_DIR, help=f"Location of the MPC dataset, containing S1, S2, ... (default: {DATA_DIR})")
+    parser.add_argument('--subjects', type=int, nargs='+', default=list(SUBJECTS), help="Subject ids to convert (default: all)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes (default: 1)")
+    parser.add_argument('--precision', type=int, default=None, help="Round the positions to this many decimals (default: full precision)")
+    parser.add_argument('--indent', type=int, default=None, help="Indent the .json files by this many spaces (default: no line breaks)")
+    parser.add_argument('--stride', type=int, default=STRIDE, help=f"Keep every n-th mocap frame, 1 keeps all {MOCAP_FPS} Hz frames (default: {STRIDE}, the 50 Hz of the videos)")
+    parser.add_argument('--format', choices=['json', 'npy', 'both'], default='json', help="json: one .json file per trial, npy: a float32 (frames, markers, 3) .npy file with a .meta.json file (marker names, fps), both: both (default: json)")
+    parser.add_argument('--profile_log', type=str, default=None, help="Append the wall time, CPU time and peak memory of every stage and trial to this JSON lines file (see profile_summary.py)")
+    parser.add_argument('--cprofile_dir', type=str, default=None, help="With --profile_log, also run every trial under cProfile and save the .prof files to this folder")
+    args = parser.parse_args()
+    if args.profile_log: profiling.enable(args.profile_log, args.cprofile_dir) # before the workers are started, they inherit it
+
+    main(args.data_dir, args.subjects, args.workers, args.precision, args.indent, args.format, args.stride)
\ No newline at end of file
@@ -0,0 +1,69 @@
+import sys
+sys.path.append("..//implementation")
+
+from pathlib import Path
+import argparse
+import json
+import pandas as pd
+
+# Summary of the stage timings that fix_c3d_folder.py, handle_S3_jumpingjacks.py and osim_to_json.py log with --profile_log
+# (see helper/profiling.py), e.g. which stages, trials and markers take the time, to decide what to route to a cheaper imputer
+
+COUNTERS = ['optimizer_runs', 'optimizer_iterations', 'optimizer_evaluations']
+
+
+def main(log_paths, by=('stage', 'method'), stages=None, top=30, csv_path=None):
+    records = load_records(log_paths)
+    if records.empty:
+        print('No records in', ', '.join(map(str, log_paths)))
+        return records
+    table = summarize(records, by, stages)
+    print(f'{len(records)} records of {records["file"].nunique() if "file" in records else 0} files, '
+          f'{records.loc[records["depth"] == 0, "wall_s"].sum():.1f} s of wall time in the outermost stages')
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(table.head(top).to_string(float_format=lambda v: f'{v:.3f}'))
+    if csv_path:
+        table.to_csv(csv_path)
+        print(f'Summary written to {csv_path}')
+    return table
+
+
+def load_records(log_paths):
+    rows = []
+    for log_path in log_paths:
+        with open(log_path) as file:
+            rows += [json.loads(line) for line in file if line.strip()]
+    return pd.DataFrame(rows)
+
+
+def summarize(records: pd.DataFrame, by=('stage', 'method'), stages=None):
+    """Totals and means per group of the records, sorted by the total wall time
+
+    wall_share is the part of the wall time of all outermost stages (e.g. whole files), nested stages are counted in
+    their parents as well. Groups by columns that not all records have (method, marker) keep those records as NaN.
+    """
+    if stages: records = records[records['stage'].isin(stages)]
+    by = [column for column in by if column in records]
+    total = records.loc[records['depth'] == 0, 'wall_s'].sum()
+
+    aggregations = {'count': ('wall_s', 'size'), 'wall_s': ('wall_s', 'sum'), 'wall_mean_s': ('wall_s', 'mean'),
+                    'wall_max_s': ('wall_s', 'max'), 'cpu_s': ('cpu_s', 'sum'), 'peak_rss_mb': ('peak_rss_mb', 'max')}
+    aggregations.update({counter: (counter, 'sum') for counter in COUNTERS if counter in records})
+    if 'error' in records: aggregations['errors'] = ('error', 'count')
+    table = records.groupby(by, dropna=False).agg(**aggregations)
+    for counter in COUNTERS:
+        if counter in table: table[counter] = table[counter].astype(int)
+    if total > 0: table['wall_share'] = table['wall_s'] / total
+    return table.sort_values('wall_s', ascending=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarize the stage timings of a --profile_log of the preprocessing scripts")
+    parser.add_argument('log_paths', type=Path, nargs='+', help="JSON lines log(s) written with --profile_log")
+    parser.add_argument('--by', type=str, nargs='+', default=['stage', 'method'], help="Columns to group by, e.g. stage method, file, or stage marker (default: stage method)")
+    parser.add_argument('--stages', type=str, nargs='+', default=None, help="Only these stages, e.g. impute_marker (default: all)")
+    parser.add_argument('--top', type=int, default=30, help="Print this many groups with the largest wall time (default: 30)")
+    parser.add_argument('--csv', type=str, default=None, help="Also write the whole summary to this csv file")
+    args = parser.parse_args()
+
+    main(args.log_paths, args.by, args.stages, args.top, args.csv)
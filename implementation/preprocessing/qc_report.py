@@ -0,0 +1,103 @@
+import sys
+sys.path.append("..//implementation")
+
+import matplotlib
+matplotlib.use('Agg') # render to files only, no windows
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from html import escape
+import argparse
+from tqdm import tqdm
+
+from helper.util import Trial, parse_trial_name
+from helper.plot_markers import marker_grid
+from helper.batch import collect_c3d_files, record_error
+from experiments.plot import plot_multi
+
+# Render the 8 x 5 marker grid of every trial to a file and write one html page per subject to review them,
+# e.g. to check the output of fix_c3d_folder.py without opening a window per trial
+
+
+def main(c3ds_dirs, out_dir, workers=1, method='none', image_format='png'):
+    out_dir = Path(out_dir)
+    Path(out_dir, 'sheets').mkdir(parents=True, exist_ok=True)
+    files = collect_c3d_files(c3ds_dirs, unique='stem') # the sheets are named after the trials
+    tasks = [(f, Path(out_dir, 'sheets', f'{f.stem}.{image_format}'), method) for f in files]
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(tqdm(executor.map(render_sheet_safe, *zip(*tasks)), total=len(tasks))) if tasks else []
+    else:
+        results = [render_sheet_safe(*task) for task in tqdm(tasks)]
+
+    write_index(out_dir, results)
+    failed = [r for r in results if r['error']]
+    print(f'{len(results) - len(failed)} of {len(results)} sheets rendered, open {Path(out_dir, "index.html")}')
+    for r in failed:
+        print(f'FAILED {r["input"]}: {r["error"]}')
+
+
+_axis = None
+def grid_axes():
+    # one figure per process, cleared and redrawn for every trial
+    global _axis
+    if _axis is None:
+        _, _axis = marker_grid()
+    return _axis
+
+
+def render_sheet_safe(c3d_file_path: Path, out_path: Path, method='none'):
+    result = {'input': str(c3d_file_path), 'name': c3d_file_path.stem, 'sheet': f'sheets/{out_path.name}', 'error': None}
+    with record_error(result):
+        trial = Trial(c3d_file_path)
+        axis = grid_axes()
+        plot_multi(trial, trial.marker_names, method, out_path=out_path, axis=axis)
+        result['gaps'] = len(trial.gaps)
+        result['markers_with_gaps'] = [trial.marker_names[m] for m in trial.gaps.markers_with_gaps()]
+        result['frames'] = trial.frame_count
+    return result
+
+
+def write_index(out_dir, results):
+    # one page per subject, with a table of its trials linking to the sheets below it
+    by_subject = defaultdict(list)
+    for r in results:
+        try:
+            subject = parse_trial_name(r['input'])[0] # e.g. s3_drinking_normal -> s3
+        except ValueError:
+            subject = 'other'
+        by_subject[subject].append(r)
+
+    for subject, subject_results in by_subject.items():
+        rows, sheets = [], []
+        for r in subject_results:
+            name = escape(r['name'])
+            if r['error']:
+                rows.append(f'<tr><td>{name}</td><td colspan="3">FAILED: {escape(r["error"])}</td></tr>')
+                continue
+            rows.append(f'<tr><td><a href="#{name}">{name}</a></td><td>{r["frames"]}</td><td>{r["gaps"]}</td><td>{escape(", ".join(r["markers_with_gaps"]))}</td></tr>')
+            if r['sheet'].endswith('.pdf'):
+                sheets.append(f'<h2 id="{name}">{name}</h2><a href="{escape(r["sheet"])}">{escape(r["sheet"])}</a>')
+            else:
+                sheets.append(f'<h2 id="{name}">{name}</h2><img src="{escape(r["sheet"])}" loading="lazy" style="max-width: 100%">')
+        page = (f'<html><head><meta charset="utf-8"><title>QC {escape(subject)}</title></head><body>'
+                f'<h1>{escape(subject)}</h1><table border="1"><tr><th>trial</th><th>frames</th><th>gaps</th><th>markers with gaps</th></tr>'
+                + ''.join(rows) + '</table>' + ''.join(sheets) + '</body></html>')
+        Path(out_dir, f'{subject}.html').write_text(page, encoding='utf-8')
+
+    links = ''.join(f'<li><a href="{escape(s)}.html">{escape(s)}</a> ({len(r)} trials)</li>' for s, r in sorted(by_subject.items()))
+    Path(out_dir, 'index.html').write_text(f'<html><head><meta charset="utf-8"><title>QC</title></head><body><h1>QC</h1><ul>{links}</ul></body></html>', encoding='utf-8')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render a QC sheet of every c3d file and an html index per subject")
+    parser.add_argument('c3ds_dirs', type=str, nargs='+', help="Path(s) to the directories containing .c3d files")
+    parser.add_argument('out_dir', type=str, help="Path to the output directory")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes (default: 1)")
+    parser.add_argument('--method', type=str, default='none', help="Imputation method applied before plotting, e.g. linear (default: none)")
+    parser.add_argument('--format', type=str, default='png', choices=['png', 'pdf'], help="File format of the sheets (default: png)")
+    args = parser.parse_args()
+
+    main(args.c3ds_dirs, args.out_dir, args.workers, args.method, args.format)